@@ -1,11 +1,19 @@
 from django.contrib import admin
 
-from activity.models import EmailSignup, GeocodedLocation, SearchFeedback, StravaAuth
+from activity.models import (
+    EmailSignup,
+    ExploredTile,
+    GeocodedLocation,
+    QueryAlias,
+    SearchFeedback,
+    Segment,
+    StravaAuth,
+)
 
 
 @admin.register(StravaAuth)
 class StravaAuthAdmin(admin.ModelAdmin):
-    list_display = ("id", "expires_at")
+    list_display = ("id", "label", "is_active", "expires_at")
 
 
 @admin.register(GeocodedLocation)
@@ -15,6 +23,13 @@ class GeocodedLocationAdmin(admin.ModelAdmin):
     ordering      = ("-created_at",)
 
 
+@admin.register(QueryAlias)
+class QueryAliasAdmin(admin.ModelAdmin):
+    list_display  = ("alias", "canonical", "created_at")
+    search_fields = ("alias", "canonical")
+    ordering      = ("-created_at",)
+
+
 @admin.register(SearchFeedback)
 class SearchFeedbackAdmin(admin.ModelAdmin):
     list_display  = ("location", "radius", "vote", "comment", "created_at")
@@ -27,3 +42,16 @@ class SearchFeedbackAdmin(admin.ModelAdmin):
 class EmailSignupAdmin(admin.ModelAdmin):
     list_display  = ("email", "created_at")
     ordering      = ("-created_at",)
+
+
+@admin.register(Segment)
+class SegmentAdmin(admin.ModelAdmin):
+    list_display  = ("strava_id", "name", "avg_grade", "distance", "updated_at")
+    search_fields = ("name",)
+    ordering      = ("-updated_at",)
+
+
+@admin.register(ExploredTile)
+class ExploredTileAdmin(admin.ModelAdmin):
+    list_display  = ("zoom", "x", "y", "explored_at")
+    ordering      = ("-explored_at",)
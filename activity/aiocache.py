@@ -0,0 +1,109 @@
+"""Async access to the default cache without a thread-pool hop.
+
+Django's cache API only offers async methods that wrap the sync client in
+sync_to_async. When the default cache is django-redis we talk to Redis with
+redis.asyncio instead, and let django-redis build the keys and encode the
+values so entries are interchangeable with django.core.cache. Any other
+backend falls back to Django's own async methods.
+"""
+
+import asyncio
+import weakref
+from typing import Any
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django_redis.client import DefaultClient
+from redis import asyncio as aioredis
+
+# redis.asyncio connections belong to the event loop they were opened on
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aioredis.Redis]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_django_redis() -> DefaultClient | None:
+    client = getattr(caches[DEFAULT_CACHE_ALIAS], "client", None)
+    return client if isinstance(client, DefaultClient) else None
+
+
+def _redis() -> aioredis.Redis:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = aioredis.from_url(settings.REDIS_URL)
+        _clients[loop] = client
+    return client
+
+
+def _px(timeout: float | None) -> int | None:
+    return None if timeout is None else max(int(timeout * 1000), 1)
+
+
+async def get(key: str, default: Any = None) -> Any:
+    dr = get_django_redis()
+    if dr is None:
+        return await cache.aget(key, default)
+    value = await _redis().get(dr.make_key(key))
+    return default if value is None else dr.decode(value)
+
+
+async def get_many(keys: list[str]) -> dict[str, Any]:
+    dr = get_django_redis()
+    if dr is None:
+        return await cache.aget_many(keys)
+    if not keys:
+        return {}
+    values = await _redis().mget([dr.make_key(k) for k in keys])
+    return {k: dr.decode(v) for k, v in zip(keys, values) if v is not None}
+
+
+async def set(key: str, value: Any, timeout: float | None) -> None:
+    dr = get_django_redis()
+    if dr is None:
+        return await cache.aset(key, value, timeout)
+    await _redis().set(dr.make_key(key), dr.encode(value), px=_px(timeout))
+
+
+async def set_many(data: dict[str, Any], timeout: float | None) -> None:
+    dr = get_django_redis()
+    if dr is None:
+        await cache.aset_many(data, timeout)
+        return
+    async with _redis().pipeline(transaction=False) as pipe:
+        for key, value in data.items():
+            pipe.set(dr.make_key(key), dr.encode(value), px=_px(timeout))
+        await pipe.execute()
+
+
+async def add(key: str, value: Any, timeout: float | None) -> bool:
+    dr = get_django_redis()
+    if dr is None:
+        return await cache.aadd(key, value, timeout)
+    return bool(await _redis().set(dr.make_key(key), dr.encode(value), px=_px(timeout), nx=True))
+
+
+async def delete_many(keys: list[str]) -> None:
+    dr = get_django_redis()
+    if dr is None:
+        await cache.adelete_many(keys)
+        return
+    if keys:
+        await _redis().delete(*[dr.make_key(k) for k in keys])
+
+
+async def incr(key: str, amount: int = 1) -> int:
+    """Increment a counter, creating it without expiry if it is missing."""
+    dr = get_django_redis()
+    if dr is None:
+        await cache.aadd(key, 0, None)
+        return await cache.aincr(key, amount)
+    return await _redis().incrby(dr.make_key(key), amount)
+
+
+async def publish(channel: str, message: bytes) -> None:
+    """Publish on a Redis channel; a no-op for other cache backends, which
+    are process-local anyway."""
+    if get_django_redis() is None:
+        return
+    await _redis().publish(channel, message)
@@ -0,0 +1,108 @@
+"""Different spellings of the same place, folded into one query.
+
+"san jose" and "san jose ca" geocode to the same spot but would otherwise
+get their own geocode entries and their own cached search responses. When
+Nominatim resolves a new query into the same SEARCH_CENTER_GRID cell as a
+place we already know, the new query is recorded as an alias of the old
+one, and from then on it is looked up and cached under the old one.
+
+Each process keeps the whole table in memory and reloads it every
+QUERY_ALIAS_TTL seconds to pick up aliases other workers recorded. Aliases
+can also be added by hand in the admin.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from activity.models import GeocodedLocation, QueryAlias
+
+logger = logging.getLogger(__name__)
+
+_aliases: dict[str, str] = {}
+_loaded_at: float | None = None
+_lock = threading.Lock()
+
+
+def _is_stale() -> bool:
+    return _loaded_at is None or time.time() - _loaded_at > settings.QUERY_ALIAS_TTL
+
+
+def _load(rows: list[tuple[str, str]]) -> None:
+    global _aliases, _loaded_at
+    with _lock:
+        _aliases = dict(rows)
+        _loaded_at = time.time()
+
+
+def resolve(normalized_query: str) -> str:
+    """The canonical spelling of an already normalized query."""
+    if _is_stale():
+        _load(list(QueryAlias.objects.values_list("alias", "canonical")))
+    return _aliases.get(normalized_query, normalized_query)
+
+
+async def aresolve(normalized_query: str) -> str:
+    if _is_stale():
+        _load([row async for row in QueryAlias.objects.values_list("alias", "canonical")])
+    return _aliases.get(normalized_query, normalized_query)
+
+
+def _cell_filter(latitude: float, longitude: float) -> dict[str, float]:
+    grid = settings.SEARCH_CENTER_GRID
+    lat = round(latitude / grid) * grid
+    lon = round(longitude / grid) * grid
+    return {
+        "latitude__gte": lat - grid / 2,
+        "latitude__lt": lat + grid / 2,
+        "longitude__gte": lon - grid / 2,
+        "longitude__lt": lon + grid / 2,
+    }
+
+
+def _remember(alias: str, canonical: str) -> None:
+    logger.info(f"aliases: {alias!r} -> {canonical!r}")
+    with _lock:
+        _aliases[alias] = canonical
+
+
+def record(normalized_query: str, latitude: float, longitude: float) -> str | None:
+    """Alias a freshly geocoded query to a known place in the same cell.
+    Returns the canonical query, or None if the place is new."""
+    existing = (
+        GeocodedLocation.objects.filter(**_cell_filter(latitude, longitude))
+        .exclude(user_query=normalized_query)
+        .order_by("created_at")
+        .first()
+    )
+    if existing is None:
+        return None
+    canonical = resolve(existing.user_query)
+    try:
+        QueryAlias.objects.create(alias=normalized_query, canonical=canonical)
+    except IntegrityError:
+        # Another worker recorded it first
+        pass
+    _remember(normalized_query, canonical)
+    return canonical
+
+
+async def arecord(normalized_query: str, latitude: float, longitude: float) -> str | None:
+    existing = (
+        await GeocodedLocation.objects.filter(**_cell_filter(latitude, longitude))
+        .exclude(user_query=normalized_query)
+        .order_by("created_at")
+        .afirst()
+    )
+    if existing is None:
+        return None
+    canonical = await aresolve(existing.user_query)
+    try:
+        await QueryAlias.objects.acreate(alias=normalized_query, canonical=canonical)
+    except IntegrityError:
+        pass
+    _remember(normalized_query, canonical)
+    return canonical
@@ -1,26 +1,63 @@
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import httpx
+import orjson
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from ninja import Query, Router
 from ninja.errors import HttpError
-from stravalib import Client
 
-from activity.models import EmailSignup, SearchFeedback, StravaAuth
+from activity import aliases, background, backoff, l1, metrics
+from activity.enrichment import aget_geometry
+from activity.models import EmailSignup, SearchFeedback
+from activity.quota import Priority, QuotaRecorder
+from activity.results import InvalidCursor, filter_segments
 from activity.schemas import (
+    CoorsSchema,
     EmailSignupRequest,
     EmailSignupResponse,
     ExplorerSegment,
     FeedbackRequest,
     FeedbackResponse,
+    LocationSuggestQuery,
+    LocationSuggestResponse,
+    SearchBatchRequest,
+    SearchPageSchema,
     SearchPayloadSchema,
-    SearchResponseSchema,
     SegmentBoundsSchema,
 )
+from activity.segment_index import (
+    get_indexed_segments,
+    save_explored_tile,
+    save_segments,
+)
+from activity.singleflight import coalesce
+from activity.suggest import suggest_locations
+from activity.tokens import StravaRateLimited, aensure_quota, areserve_access_token, get_client
+from activity.upstream import aexplore_segments
 from activity.utils import (
+    Tile,
+    aclaim_refresh,
+    aget_cached_response,
+    aget_cached_segments,
+    aget_coors,
+    aget_covering_segments,
+    aset_cached_response,
+    aset_cached_segments,
+    canonical_area,
+    generate_tile_cache_key,
     get_bounds,
-    get_cached_segments,
-    get_coors,
+    get_tile_bounds,
+    get_tiles,
+    merge_tile_segments,
     normalize_query,
+    search_response_key,
     set_cached_segments,
+    to_search_segments,
 )
 
 router = Router()
@@ -28,12 +65,8 @@ logger = logging.getLogger(__name__)
 
 
 @router.post("/")
-def get_segment(request, payload: SegmentBoundsSchema):
-    client = Client()
-    strava_auth = StravaAuth.objects.get(id=1)
-    strava_auth.check_and_refresh(client)
-
-    client.access_token = strava_auth.access_token
+async def get_segment(request, payload: SegmentBoundsSchema):
+    auth_id, access_token = await areserve_access_token()
 
     bounds = (
         payload.sw_lat,
@@ -42,64 +75,321 @@ def get_segment(request, payload: SegmentBoundsSchema):
         payload.ne_lon,
     )
 
-    segments = client.explore_segments(
-        bounds, activity_type="riding", min_cat=1, max_cat=4
-    )  # Get current athlete details
-    data = [s.model_dump(mode="json") for s in segments]
+    data = await aexplore_segments(access_token, bounds, QuotaRecorder(auth_id))
+    await sync_to_async(save_segments)([ExplorerSegment(**s) for s in data])
 
     return data
 
 
-def get_response_schema(explore_segments: list[ExplorerSegment]):
-    response_schema: list[SearchResponseSchema] = []
-
-    for item in explore_segments:
-        response_schema.append(
-            SearchResponseSchema(
-                id=item.id,
-                name=item.name,
-                difficulty=item.get_difficulty(),
-                distance=item.to_miles(),
-                avg_grade=item.avg_grade,
-                start_latlng=item.start_latlng,
-                end_latlng=item.end_latlng,
-                elev_difference=item.elev_difference,
+def store_tile_segments(tile: Tile, explore_segments: list[ExplorerSegment]) -> list[dict]:
+    """Index and cache a tile's explore result, returning its search payload.
+    Empty tiles are cached too, so the next search over them skips Strava."""
+    save_explored_tile(tile, explore_segments)
+    data = to_search_segments(explore_segments)
+    set_cached_segments(generate_tile_cache_key(tile), data)
+    return data
+
+
+def fetch_tile_segments(
+    tiles: list[Tile], priority: Priority = "user"
+) -> tuple[dict[str, list[dict]], dict[str, Exception]]:
+    """Blocking tile fetch through stravalib, for work off the event loop.
+
+    Each tile is stored as soon as its call returns. Returns the stored
+    tiles' segments and, by key, why the others failed: StravaRateLimited
+    when no account had quota left (no call was made), otherwise the error
+    the call raised.
+    """
+
+    def explore(tile: Tile) -> list[ExplorerSegment]:
+        # Each call picks its own account so a batch spreads across the pool
+        client = get_client(priority)
+        strava_explore_segments = client.explore_segments(
+            get_tile_bounds(tile).to_list(), activity_type="riding", min_cat=1, max_cat=4
+        )
+        return [ExplorerSegment(**s.__dict__) for s in strava_explore_segments]
+
+    fetched: dict[str, list[dict]] = {}
+    errors: dict[str, Exception] = {}
+    workers = min(len(tiles), settings.SEGMENT_TILE_FETCH_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(explore, tile): tile for tile in tiles}
+        for future in as_completed(futures):
+            tile = futures[future]
+            key = generate_tile_cache_key(tile)
+            try:
+                fetched[key] = store_tile_segments(tile, future.result())
+            except StravaRateLimited as e:
+                logger.warning(f"search: no quota for tile {tile}, retry in {e.retry_after}s")
+                errors[key] = e
+            except Exception as e:
+                logger.exception(f"search: explore failed for tile {tile}")
+                errors[key] = e
+    return fetched, errors
+
+
+async def afetch_tile_segments(
+    tiles: list[Tile], priority: Priority = "user"
+) -> dict[str, list[dict]]:
+    """Fetch tiles from Strava concurrently on the event loop.
+
+    Each tile is stored as soon as its call returns. Tiles no account had
+    quota left for, that failed with a transient error or are backing off
+    from an earlier failure are left out of the result. Raises
+    StravaRateLimited, with the soonest retry, if quota ran out before any
+    tile was fetched.
+    """
+    blocked = await backoff.ablocked([generate_tile_cache_key(t) for t in tiles])
+    if blocked:
+        l1.record("backoff.segments.blocked", len(blocked))
+        tiles = [t for t in tiles if generate_tile_cache_key(t) not in blocked]
+    limited: list[StravaRateLimited] = []
+
+    async def explore(tile: Tile) -> tuple[str, list[dict]] | None:
+        # Each call picks its own account so a batch spreads across the pool
+        try:
+            auth_id, access_token = await areserve_access_token(priority)
+        except StravaRateLimited as e:
+            logger.warning(f"search: no quota for tile {tile}, retry in {e.retry_after}s")
+            limited.append(e)
+            return None
+        try:
+            segments = await aexplore_segments(
+                access_token, get_tile_bounds(tile).to_list(), QuotaRecorder(auth_id)
             )
+        except httpx.HTTPError as e:
+            if not backoff.is_transient(e):
+                raise
+            logger.warning(f"search: explore failed for tile {tile}: {e!r}")
+            await backoff.arecord_failure(generate_tile_cache_key(tile), "segments")
+            return None
+        data = await sync_to_async(store_tile_segments)(
+            tile, [ExplorerSegment(**s) for s in segments]
         )
-    return response_schema
+        return generate_tile_cache_key(tile), data
 
+    results = await asyncio.gather(*(explore(tile) for tile in tiles))
+    fetched = dict(r for r in results if r is not None)
+    if limited and not fetched:
+        raise StravaRateLimited(min(e.retry_after for e in limited))
+    return fetched
 
-@router.get("/search")
-def search(request, payload: Query[SearchPayloadSchema]):
-    client = Client()
-    strava_auth = StravaAuth.objects.get(id=1)
-    strava_auth.check_and_refresh(client)
 
-    client.access_token = strava_auth.access_token
+async def refresh_stale_tiles(tiles: list[Tile]) -> None:
+    """Refresh tiles past their soft TTL without holding up the request."""
+    claimed = [t for t in tiles if await aclaim_refresh(generate_tile_cache_key(t))]
+    if claimed:
+        logger.info(f"search: refreshing {len(claimed)} stale tiles in background")
+        background.submit(fetch_tile_segments, claimed, "background")
 
-    coors = get_coors(payload.location)
-    if not coors:
-        raise HttpError(500, "Coordinates could not be found for the provided location")
 
-    bounds = get_bounds(coors, payload.radius)
+async def load_cached_tiles(
+    tiles: list[Tile],
+) -> tuple[dict[str, list[dict]], list[Tile], list[str]]:
+    """Segments for each tile we can answer without Strava, keyed by tile
+    cache key, the tiles that still need fetching and the keys served stale."""
+    # Each tile is cached on its own, so searches that overlap an earlier one
+    # only go to Strava for the tiles nobody has asked for yet.
+    tile_keys = {generate_tile_cache_key(tile): tile for tile in tiles}
+    tile_segments, stale = await aget_cached_segments(list(tile_keys))
+    if stale:
+        await refresh_stale_tiles([tile_keys[k] for k in stale])
+    missing = [tile for key, tile in tile_keys.items() if key not in tile_segments]
+    if missing:
+        # Tiles inside a coarser tile that a wider search already cached
+        covered, covering_stale = await aget_covering_segments(missing)
+        if covering_stale:
+            await refresh_stale_tiles(covering_stale)
+        if covered:
+            await metrics.aincr("search.tiles_from_ancestor", len(covered))
+        tile_segments.update(covered)
+        missing = [t for t in missing if generate_tile_cache_key(t) not in covered]
+    if missing:
+        # Tiles we explored recently are answered from the segments stored
+        # in the DB. They keep the age they were explored at, so old ones go
+        # back into Redis stale and are refreshed like any other stale tile.
+        indexed = await sync_to_async(get_indexed_segments)(missing)
+        indexed_stale = []
+        for key, (data, explored_at) in indexed.items():
+            tile_segments[key] = data
+            if await aset_cached_segments(key, data, explored_at) < time.time():
+                indexed_stale.append(key)
+        if indexed_stale:
+            await refresh_stale_tiles([tile_keys[k] for k in indexed_stale])
+            stale = stale + indexed_stale
+        missing = [t for t in missing if generate_tile_cache_key(t) not in indexed]
+    return tile_segments, missing, stale
 
-    cached_data, cache_key = get_cached_segments(
-        bounds.sw_lat, bounds.sw_lon, bounds.ne_lat, bounds.ne_lon
-    )
-    if cached_data:
-        return {"source": "cached", "segments": cached_data}
 
-    # data = [{"avg_grade": 10.2, "id": 1, "name": "Hawk hill", "distance": 3.2}]
-    strava_explore_segments = client.explore_segments(
-        bounds.to_list(), activity_type="riding", min_cat=1, max_cat=4
+async def fetch_missing_tiles(tiles: list[Tile]) -> dict[str, list[dict]]:
+    """Fetch tiles from Strava; tiles it couldn't be reached for are left out.
+    Raises StravaRateLimited if there was no quota for any of them."""
+    tile_keys = {generate_tile_cache_key(tile): tile for tile in tiles}
+    # Concurrent searches missing the same tiles share one Strava fetch
+    return await coalesce(
+        list(tile_keys),
+        lambda keys: afetch_tile_segments([tile_keys[k] for k in keys]),
     )
-    explore_segments: list[ExplorerSegment] = [
-        ExplorerSegment(**s.__dict__) for s in strava_explore_segments
+
+
+async def load_tiles(
+    tiles: list[Tile],
+) -> tuple[dict[str, list[dict]], set[str], list[str], StravaRateLimited | None]:
+    """Segments for each tile, keyed by tile cache key, the keys that had to
+    be fetched from Strava, the keys served stale and, if the missing tiles
+    couldn't be fetched for lack of quota, that error. Tiles Strava couldn't
+    be reached for are missing from the segments."""
+    tile_segments, missing, stale = await load_cached_tiles(tiles)
+    fetched: dict[str, list[dict]] = {}
+    rate_limited = None
+    if missing:
+        logger.info(f"search: fetching {len(missing)}/{len(tiles)} tiles")
+        try:
+            fetched = await fetch_missing_tiles(missing)
+        except StravaRateLimited as e:
+            rate_limited = e
+        tile_segments.update(fetched)
+    return tile_segments, set(fetched), stale, rate_limited
+
+
+async def attach_geometry(page: dict, zoom: int) -> bool:
+    """Add polylines for zoom and elevation profiles to a page's segments.
+    Returns False if some segments don't have them yet; those are queued
+    for enrichment and get nulls for now."""
+    geometry = await aget_geometry([s["id"] for s in page["segments"]], zoom)
+    # New dicts, the page's segments are shared with the tile caches
+    page["segments"] = [
+        {**s, **geometry.get(s["id"], {"polyline": None, "elevation": None})}
+        for s in page["segments"]
     ]
-    response_schema = get_response_schema(explore_segments)
-    data = [s.model_dump(mode="json") for s in response_schema]
-    if data:
-        set_cached_segments(cache_key, data)
+    return all(s["id"] in geometry for s in page["segments"])
+
+
+def search_response(source: str, body: bytes) -> HttpResponse:
+    # body is an encoded page object; splice the source in front of its fields
+    return HttpResponse(
+        b'{"source":"' + source.encode() + b'",' + body[1:],
+        content_type="application/json",
+    )
+
+
+async def stream_search(
+    payload: SearchPayloadSchema, coors: CoorsSchema
+) -> StreamingHttpResponse:
+    """search, sending segments as they are found.
+
+    Segments from cached tiles go out in the first message, then those of
+    each tile fetched from Strava as it arrives, then a "done" message with
+    the total. Each message is filtered and sorted like a page, but order
+    isn't kept across messages, so there is no cursor; limit caps the total.
+    Raises StravaRateLimited like search if nothing is cached and no
+    account has quota left.
+    """
+    bounds = get_bounds(*canonical_area(coors, payload.radius))
+    tiles = get_tiles(bounds)
+    cached, missing, _ = await load_cached_tiles(tiles)
+    if missing and not cached:
+        # Nothing can be sent before Strava answers, so say now if it won't,
+        # while the status can still be 503
+        await aensure_quota()
+    # The limit is applied across messages, not to each one
+    query = payload.model_copy(update={"limit": None, "cursor": None})
+
+    def encode(event: str, data: dict) -> bytes:
+        if payload.stream == "sse":
+            return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+        return orjson.dumps({"event": event, **data}) + b"\n"
+
+    async def batches(cached: dict, pending: list[asyncio.Future]):
+        """(source, segments by tile key) for the cached tiles, then for each
+        fetch as it completes. A tile Strava couldn't be reached for is
+        missing from its fetch's result."""
+        yield "cached", cached
+        for fetch in asyncio.as_completed(pending):
+            try:
+                tile_segments = await fetch
+            except StravaRateLimited:
+                tile_segments = {}
+            yield "strava", tile_segments
+
+    async def events():
+        # Start the fetches before sending anything, one per tile so each
+        # can be sent as soon as it resolves
+        pending = [asyncio.ensure_future(fetch_missing_tiles([tile])) for tile in missing]
+        seen: set[int] = set()
+        remaining = payload.limit
+        unavailable = 0
+        try:
+            async for source, tile_segments in batches(cached, pending):
+                if source == "strava" and not tile_segments:
+                    unavailable += 1
+                if remaining == 0:
+                    # Fetches still running finish in the background and
+                    # fill the cache for the next search
+                    break
+                data = merge_tile_segments(tile_segments.values(), bounds)
+                page = filter_segments([s for s in data if s["id"] not in seen], coors, query)
+                if remaining is not None:
+                    page["segments"] = page["segments"][:remaining]
+                    remaining -= len(page["segments"])
+                if not page["segments"]:
+                    continue
+                seen.update(s["id"] for s in page["segments"])
+                if payload.zoom is not None:
+                    await attach_geometry(page, payload.zoom)
+                yield encode("segments", {"source": source, "segments": page["segments"]})
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client went away, nobody is waiting for the rest
+            for fetch in pending:
+                fetch.cancel()
+            raise
+        yield encode("done", {"total": len(seen), "partial": unavailable > 0})
+
+    response = StreamingHttpResponse(
+        events(),
+        content_type="text/event-stream" if payload.stream == "sse" else "application/x-ndjson",
+    )
+    response["Cache-Control"] = "no-cache"
+    # Proxies must pass each message on as it comes
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+# The page is returned as pre-encoded bytes, so ninja passes it through and
+# the schema only documents it
+@router.get("/search", response=SearchPageSchema)
+async def search(request, payload: Query[SearchPayloadSchema]):
+    if payload.stream:
+        if payload.cursor:
+            raise HttpError(400, "cursor is not supported when streaming")
+        coors = await aget_coors(payload.location)
+        if not coors:
+            raise HttpError(500, "Coordinates could not be found for the provided location")
+        return await stream_search(payload, coors)
+
+    # Repeat searches are answered with the bytes encoded the first time,
+    # skipping geocoding, the tile lookup and serialization entirely.
+    location = await aliases.aresolve(normalize_query(payload.location))
+    response_key = search_response_key(payload, location)
+    body = await aget_cached_response(response_key)
+    if body is not None:
+        return search_response("cached", body)
+
+    coors = await aget_coors(payload.location)
+    if not coors:
+        raise HttpError(500, "Coordinates could not be found for the provided location")
+
+    # Tiles are loaded for the canonical area around the search, and
+    # filter_segments cuts the result back to the exact center and radius
+    bounds = get_bounds(*canonical_area(coors, payload.radius))
+    tiles = get_tiles(bounds)
+    tile_segments, fetched, stale, rate_limited = await load_tiles(tiles)
+    if not tile_segments:
+        if rate_limited:
+            raise rate_limited
+        raise HttpError(503, "Strava is unavailable, try again shortly")
+
+    data = merge_tile_segments(tile_segments.values(), bounds)
     # data = [
     #     {
     #         "id": 627158,
@@ -110,28 +400,106 @@ def search(request, payload: Query[SearchPayloadSchema]):
     #         "start_latlng": [37.8331119, -122.4834356],
     #         "end_latlng": [37.8280722, -122.4981393],
     #     },
-    #     {
-    #         "id": 8109834,
-    #         "name": "Old La Honda (Bridge to Mailboxes)",
-    #         "difficulty": "Easy",
-    #         "distance": 3.1,
-    #         "avg_grade": 7.8,
-    #         "start_latlng": [37.8331119, -122.4834356],
-    #         "end_latlng": [37.8280722, -122.4981393],
-    #     },
     # ]
-    return {"source": "strava", "segments": data}
+    try:
+        page = filter_segments(data, coors, payload)
+    except InvalidCursor as e:
+        raise HttpError(400, str(e))
+
+    complete = True
+    if payload.zoom is not None:
+        complete = await attach_geometry(page, payload.zoom)
+    # Some tiles failed upstream: answer with the rest, but don't keep it
+    partial = len(tile_segments) < len(tiles)
+    if partial:
+        page["partial"] = True
+    body = orjson.dumps(page)
+    # Responses built from stale tiles or missing geometry wait for the
+    # refresh or enrichment instead
+    if not stale and not partial and complete:
+        await aset_cached_response(response_key, body)
+    return search_response("strava" if fetched else "cached", body)
+
+
+@router.post("/search/batch")
+async def search_batch(request, payload: SearchBatchRequest):
+    """Run several searches in one round trip.
+
+    Locations are geocoded once each, and the searches share one tile
+    lookup, so a tile under several overlapping areas is fetched from Strava
+    only once and all missing tiles are fetched concurrently.
+    """
+    # canonical location -> the first spelling of it, which goes to Nominatim
+    canonical = {
+        query.location: await aliases.aresolve(normalize_query(query.location))
+        for query in payload.queries
+    }
+    locations: dict[str, str] = {}
+    for query in payload.queries:
+        locations.setdefault(canonical[query.location], query.location)
+    found = await asyncio.gather(*(aget_coors(raw) for raw in locations.values()))
+    coors = dict(zip(locations, found))
+
+    query_tiles: list[tuple[CoorsSchema, SegmentBoundsSchema, list[Tile]] | None] = []
+    for query in payload.queries:
+        center = coors[canonical[query.location]]
+        if center is None:
+            query_tiles.append(None)
+            continue
+        bounds = get_bounds(*canonical_area(center, query.radius))
+        query_tiles.append((center, bounds, get_tiles(bounds)))
+
+    all_tiles = list(dict.fromkeys(t for q in query_tiles if q for t in q[2]))
+    tile_segments, fetched, _, rate_limited = await load_tiles(all_tiles)
+
+    results = []
+    for query, tiles in zip(payload.queries, query_tiles):
+        result = {"location": query.location, "radius": query.radius}
+        results.append(result)
+        if tiles is None:
+            result["error"] = "Coordinates could not be found for the provided location"
+            continue
+        center, bounds, tiles = tiles
+        keys = [generate_tile_cache_key(t) for t in tiles]
+        if not any(k in tile_segments for k in keys):
+            # The same answers search gives when no tile could be loaded
+            if rate_limited:
+                result["error"] = "Strava rate limit reached, please retry later"
+                result["retry_after"] = rate_limited.retry_after
+            else:
+                result["error"] = "Strava is unavailable, try again shortly"
+            continue
+        data = merge_tile_segments(
+            [tile_segments[k] for k in keys if k in tile_segments], bounds
+        )
+        try:
+            page = filter_segments(data, center, query)
+        except InvalidCursor as e:
+            result["error"] = str(e)
+            continue
+        if query.zoom is not None:
+            await attach_geometry(page, query.zoom)
+        result["source"] = "strava" if fetched.intersection(keys) else "cached"
+        result.update(page)
+        if any(k not in tile_segments for k in keys):
+            result["partial"] = True
+    return {"results": results}
+
+
+@router.get("/locations/suggest", response=LocationSuggestResponse)
+def suggest(request, payload: Query[LocationSuggestQuery]):
+    return {"suggestions": suggest_locations(payload.q, payload.limit)}
 
 
 @router.post("/newsletter/signup", response=EmailSignupResponse)
-def newsletter_signup(request, payload: EmailSignupRequest):
-    EmailSignup.objects.get_or_create(email=payload.email)
+async def newsletter_signup(request, payload: EmailSignupRequest):
+    await EmailSignup.objects.aget_or_create(email=payload.email)
     return {"ok": True}
 
 
 @router.post("/feedback", response=FeedbackResponse)
-def submit_feedback(request, payload: FeedbackRequest):
-    SearchFeedback.objects.create(
+async def submit_feedback(request, payload: FeedbackRequest):
+    await SearchFeedback.objects.acreate(
         location=normalize_query(payload.location),
         radius=payload.radius,
         vote=payload.vote,
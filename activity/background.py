@@ -0,0 +1,41 @@
+import logging
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+logger = logging.getLogger(__name__)
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix="background"
+        )
+    return _executor
+
+
+def task(fn: Callable, *args, **kwargs) -> Callable[[], object]:
+    """fn bound to its arguments, ready to run on a pool thread: failures
+    are logged instead of lost in the future, and DB connections closed."""
+
+    def run():
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            logger.exception(f"background: {fn.__name__} failed")
+        finally:
+            # Pool threads outlive the task, don't leave DB connections open
+            connections.close_all()
+
+    return run
+
+
+def submit(fn: Callable, *args, **kwargs) -> Future:
+    """Run fn off the request path on the shared background pool."""
+    return get_executor().submit(task(fn, *args, **kwargs))
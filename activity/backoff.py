@@ -0,0 +1,77 @@
+"""Back off from upstream calls that keep failing.
+
+A timeout or 5xx for a key (a geocode query, a tile) leaves a marker in
+Redis, and no call is made for that key until the marker's block runs out.
+Each consecutive failure doubles the block, from UPSTREAM_FAILURE_BACKOFF
+up to UPSTREAM_FAILURE_BACKOFF_MAX seconds. The count is kept for another
+UPSTREAM_FAILURE_BACKOFF_MAX after the block, so a key that starts failing
+again soon after picks up where it left off.
+"""
+
+import logging
+import time
+from collections.abc import Sequence
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+
+from activity import aiocache, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_key(key: str) -> str:
+    return f"backoff:{key}"
+
+
+def is_transient(error: Exception) -> bool:
+    """Errors worth retrying later: the upstream was down, slow or busy."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _blocked(keys: Sequence[str], markers: dict[str, dict]) -> set[str]:
+    now = time.time()
+    return {k for k in keys if markers.get(backoff_key(k), {}).get("until", 0) > now}
+
+
+def _next_marker(marker: dict | None) -> tuple[dict, float]:
+    failures = (marker or {}).get("failures", 0) + 1
+    delay = min(
+        settings.UPSTREAM_FAILURE_BACKOFF * 2 ** (failures - 1),
+        settings.UPSTREAM_FAILURE_BACKOFF_MAX,
+    )
+    return {"failures": failures, "until": time.time() + delay}, delay
+
+
+def blocked(keys: Sequence[str]) -> set[str]:
+    """The keys still inside a backoff block."""
+    if not keys:
+        return set()
+    return _blocked(keys, cache.get_many([backoff_key(k) for k in keys]))
+
+
+async def ablocked(keys: Sequence[str]) -> set[str]:
+    if not keys:
+        return set()
+    return _blocked(keys, await aiocache.get_many([backoff_key(k) for k in keys]))
+
+
+def record_failure(key: str, service: str) -> float:
+    """Start or extend the block for key, returning its length in seconds."""
+    marker, delay = _next_marker(cache.get(backoff_key(key)))
+    cache.set(backoff_key(key), marker, timeout=delay + settings.UPSTREAM_FAILURE_BACKOFF_MAX)
+    metrics.incr(f"backoff.{service}.failure")
+    logger.warning(f"backoff: {key} failed {marker['failures']} times, blocked for {delay:.0f}s")
+    return delay
+
+
+async def arecord_failure(key: str, service: str) -> float:
+    marker, delay = _next_marker(await aiocache.get(backoff_key(key)))
+    await aiocache.set(backoff_key(key), marker, delay + settings.UPSTREAM_FAILURE_BACKOFF_MAX)
+    await metrics.aincr(f"backoff.{service}.failure")
+    logger.warning(f"backoff: {key} failed {marker['failures']} times, blocked for {delay:.0f}s")
+    return delay
@@ -0,0 +1,145 @@
+"""Process-wide pooled HTTP clients for Strava and Nominatim.
+
+Every upstream call used to open a fresh TCP+TLS connection. These clients
+keep connections alive between calls and count how many requests each
+upstream served and how many new connections that took, so the reuse rate
+shows up in metrics: upstream.<service>.requests / .connections.
+"""
+
+import asyncio
+import threading
+import weakref
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from activity import metrics
+
+SERVICES = {
+    "www.strava.com": "strava",
+    "nominatim.openstreetmap.org": "nominatim",
+}
+
+
+def _service(host: str | None) -> str:
+    return SERVICES.get(host or "", host or "unknown")
+
+
+class _CountingPoolMixin:
+    def _new_conn(self):
+        metrics.incr(f"upstream.{_service(self.host)}.connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+def _count_request(response: requests.Response, *args, **kwargs) -> None:
+    metrics.incr(f"upstream.{_service(urlsplit(response.url).hostname)}.requests")
+
+
+def _instrument(session: requests.Session) -> None:
+    session.hooks["response"].append(_count_request)
+    for adapter in session.adapters.values():
+        adapter.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class PooledSession(requests.Session):
+    """A requests session that applies UPSTREAM_TIMEOUT when the caller
+    doesn't pass one; stravalib never does."""
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", settings.UPSTREAM_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+_session: PooledSession | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """The shared session behind every stravalib Client.
+
+    Sessions are safe to share between threads; urllib3 hands each thread
+    its own connection from the pool. Each call carries its own bearer
+    token, so accounts never share credentials through the session.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = PooledSession()
+                # Cookies would otherwise leak between pooled accounts
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(
+                    pool_connections=len(SERVICES),
+                    pool_maxsize=settings.UPSTREAM_POOL_SIZE,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _instrument(session)
+                _session = session
+    return _session
+
+
+# httpx connections belong to the event loop they were opened on
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+async def _count_async_request(response: httpx.Response) -> None:
+    await metrics.aincr(f"upstream.{_service(response.request.url.host)}.requests")
+
+
+async def trace(event: str, info: dict) -> None:
+    """httpcore trace hook, passed per request as extensions={"trace": trace}."""
+    if event == "connection.connect_tcp.started":
+        await metrics.aincr(f"upstream.{_service(info['host'])}.connections")
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """The shared httpx client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=settings.UPSTREAM_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.UPSTREAM_POOL_SIZE * len(SERVICES),
+                max_keepalive_connections=settings.UPSTREAM_POOL_SIZE * len(SERVICES),
+                keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"response": [_count_async_request]},
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def get_connection_stats() -> dict[str, dict[str, int]]:
+    """Requests, new connections and reused connections per upstream service."""
+    names = [f"upstream.{s}.{kind}" for s in SERVICES.values() for kind in ("requests", "connections")]
+    values = metrics.get_metrics(names)
+    stats = {}
+    for service in SERVICES.values():
+        sent = values[f"upstream.{service}.requests"]
+        opened = values[f"upstream.{service}.connections"]
+        stats[service] = {
+            "requests": sent,
+            "connections": opened,
+            "reused": max(sent - opened, 0),
+        }
+    return stats
@@ -0,0 +1,145 @@
+"""Compact binary encoding for cached tile payloads.
+
+A pickled list of dicts repeats every field name for every segment. This
+codec stores the fields as columns instead, with optional compression:
+
+    header: magic, format version, compression, segment count, fresh_until
+    body:   ids (int64), difficulty (uint8), distance, avg_grade,
+            elev_difference, start lat/lng, end lat/lng (float64),
+            name lengths (uint32), then the UTF-8 names back to back
+
+Floats stay float64 so decoded payloads are identical to what was stored.
+The version header lets the layout change later: entries in an unknown
+format are treated as cache misses and refetched.
+"""
+
+import functools
+import logging
+import struct
+
+import numpy as np
+
+from activity.difficulty import DIFFICULTY_LEVELS
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover - optional
+    lz4_frame = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"NCSG"
+VERSION = 1
+HEADER = struct.Struct("<4sBBId")
+
+COMPRESSIONS = {"none": 0, "zstd": 1, "lz4": 2}
+_DIFFICULTY_RANK = {label: rank for rank, label in enumerate(DIFFICULTY_LEVELS)}
+_FLOAT_FIELDS = ("distance", "avg_grade", "elev_difference")
+
+
+class CodecError(ValueError):
+    pass
+
+
+@functools.cache
+def available_compression(name: str) -> str:
+    """name if its library is installed, otherwise "none"."""
+    if (name == "zstd" and zstandard is None) or (name == "lz4" and lz4_frame is None):
+        logger.warning(f"codec: {name} is not installed, caching uncompressed")
+        return "none"
+    if name not in COMPRESSIONS:
+        raise ValueError(f"Unknown cache compression {name!r}")
+    return name
+
+
+def _compress(body: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if compression == "lz4":
+        return lz4_frame.compress(body)
+    return body
+
+
+def _decompress(body: bytes, compression_id: int) -> bytes:
+    if compression_id == COMPRESSIONS["none"]:
+        return body
+    if compression_id == COMPRESSIONS["zstd"] and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(body)
+    if compression_id == COMPRESSIONS["lz4"] and lz4_frame is not None:
+        return lz4_frame.decompress(body)
+    raise CodecError(f"Can't decompress cache entry (compression {compression_id})")
+
+
+def encode_segments(data: list[dict], fresh_until: float, compression: str = "none") -> bytes:
+    """Pack search payload segments and their soft expiry into bytes."""
+    names = [s["name"].encode() for s in data]
+    columns = [
+        np.array([s["id"] for s in data], dtype="<i8"),
+        np.array([_DIFFICULTY_RANK[s["difficulty"]] for s in data], dtype="u1"),
+        *(np.array([s[f] for s in data], dtype="<f8") for f in _FLOAT_FIELDS),
+        np.array([s["start_latlng"] for s in data], dtype="<f8").reshape(-1, 2),
+        np.array([s["end_latlng"] for s in data], dtype="<f8").reshape(-1, 2),
+        np.array([len(n) for n in names], dtype="<u4"),
+    ]
+    body = b"".join(c.tobytes() for c in columns) + b"".join(names)
+    header = HEADER.pack(MAGIC, VERSION, COMPRESSIONS[compression], len(data), fresh_until)
+    return header + _compress(body, compression)
+
+
+def decode_segments(raw: bytes) -> tuple[list[dict], float]:
+    """The segments and fresh_until stored by encode_segments."""
+    if len(raw) < HEADER.size:
+        raise CodecError("Truncated cache entry")
+    magic, version, compression_id, count, fresh_until = HEADER.unpack_from(raw)
+    if magic != MAGIC or version != VERSION:
+        raise CodecError(f"Not a version {VERSION} segment cache entry")
+    try:
+        body = _decompress(raw[HEADER.size :], compression_id)
+    except CodecError:
+        raise
+    except Exception as e:
+        raise CodecError("Corrupt compressed cache entry") from e
+
+    offset = 0
+
+    def take(dtype: str, shape: tuple[int, ...]) -> np.ndarray:
+        nonlocal offset
+        column = np.frombuffer(body, dtype=dtype, count=int(np.prod(shape)), offset=offset)
+        offset += column.nbytes
+        return column.reshape(shape)
+
+    try:
+        ids = take("<i8", (count,)).tolist()
+        ranks = take("u1", (count,)).tolist()
+        floats = [take("<f8", (count,)).tolist() for _ in _FLOAT_FIELDS]
+        starts = take("<f8", (count, 2)).tolist()
+        ends = take("<f8", (count, 2)).tolist()
+        name_lengths = take("<u4", (count,)).tolist()
+    except ValueError as e:
+        raise CodecError("Truncated cache entry") from e
+
+    data = []
+    for i in range(count):
+        try:
+            name = body[offset : offset + name_lengths[i]].decode()
+        except UnicodeDecodeError as e:
+            raise CodecError("Corrupt segment name in cache entry") from e
+        offset += name_lengths[i]
+        data.append(
+            {
+                "id": ids[i],
+                "name": name,
+                "difficulty": DIFFICULTY_LEVELS[ranks[i]],
+                "distance": floats[0][i],
+                "avg_grade": floats[1][i],
+                "start_latlng": starts[i],
+                "end_latlng": ends[i],
+                "elev_difference": floats[2][i],
+            }
+        )
+    return data, fresh_until
@@ -0,0 +1,65 @@
+"""Difficulty scoring over whole arrays of segments.
+
+The score starts from elevation gain, adds a grade term that turns
+quadratic on steep climbs and a capped distance term for sustained
+effort, then adds flat bonuses for walls and big mountains. Weights and
+label thresholds can be tuned through settings.DIFFICULTY_SCORING, e.g.
+{"thresholds": (150, 450, 900)}; anything not given keeps its default.
+"""
+
+from typing import Literal, get_args
+
+import numpy as np
+from django.conf import settings
+
+# Difficulty labels from easiest to hardest
+Difficulty = Literal["Easy", "Moderate", "Hard", "Brutal"]
+DIFFICULTY_LEVELS: tuple[str, ...] = get_args(Difficulty)
+
+DEFAULT_SCORING = {
+    "gain_weight": 1.0,
+    # Over steep_grade % every bit of grade hurts significantly more
+    "steep_grade": 8.0,
+    "steep_weight": 2.0,  # times grade squared
+    "grade_weight": 15.0,  # times grade, below steep_grade
+    # Distance adds fatigue, capped so a flat 50km ride isn't "Brutal"
+    "distance_weight": 25.0,  # per km
+    "distance_cap": 300.0,
+    # "The Wall" and "Big Mountain" overrides
+    "wall_grade": 15.0,
+    "wall_bonus": 300.0,
+    "big_climb_gain": 500.0,  # meters
+    "big_climb_bonus": 200.0,
+    # Upper score bounds of Easy, Moderate and Hard; anything above is Brutal
+    "thresholds": (150.0, 400.0, 800.0),
+}
+
+
+def get_scoring() -> dict:
+    return {**DEFAULT_SCORING, **settings.DIFFICULTY_SCORING}
+
+
+def score_segments(distance, elev_difference, avg_grade, scoring: dict | None = None) -> np.ndarray:
+    """Scores for segments given as arrays of meters, meters and percent."""
+    w = scoring or get_scoring()
+    distance_km = np.asarray(distance, dtype=float) / 1000
+    gain_m = np.abs(np.asarray(elev_difference, dtype=float))
+    grade = np.abs(np.asarray(avg_grade, dtype=float))
+
+    score = gain_m * w["gain_weight"]
+    score += np.where(
+        grade > w["steep_grade"], grade**2 * w["steep_weight"], grade * w["grade_weight"]
+    )
+    score += np.minimum(distance_km * w["distance_weight"], w["distance_cap"])
+    score += np.where(grade >= w["wall_grade"], w["wall_bonus"], 0.0)
+    score += np.where(gain_m > w["big_climb_gain"], w["big_climb_bonus"], 0.0)
+    return score
+
+
+def classify(distance, elev_difference, avg_grade, scoring: dict | None = None) -> list[str]:
+    """Difficulty labels for arrays of segments, in one pass."""
+    scoring = scoring or get_scoring()
+    scores = score_segments(distance, elev_difference, avg_grade, scoring)
+    # A score equal to a threshold falls in the harder bucket
+    levels = np.searchsorted(np.asarray(scoring["thresholds"], dtype=float), scores, side="right")
+    return [DIFFICULTY_LEVELS[i] for i in levels.tolist()]
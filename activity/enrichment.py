@@ -0,0 +1,183 @@
+"""Segment geometry for the map, fetched in the background.
+
+Strava's explorer only returns a segment's start and end points. When a
+search asks for geometry, segments we don't have it for yet are queued
+here, and a small worker pool fetches their streams (latlng, distance,
+altitude) with background quota, one call per segment.
+
+The full-resolution line and an elevation profile are kept on the Segment
+row. What searches read is a compact entry in Redis per segment: the line
+simplified with Douglas-Peucker for each of GEOMETRY_ZOOMS, encoded as a
+polyline, so a zoomed-out map gets a few points per segment and a
+zoomed-in one gets the detail. Segments Strava has no streams for get an
+empty entry so they aren't fetched again.
+"""
+
+import logging
+import math
+import threading
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import orjson
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from activity import aiocache, background, geo, polyline
+from activity.models import Segment
+from activity.tokens import StravaRateLimited, get_client
+
+logger = logging.getLogger(__name__)
+
+# Set while the background budget is spent, so queued work stops early
+PAUSED_KEY = "enrichment:paused"
+
+_executor: ThreadPoolExecutor | None = None
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def geometry_key(segment_id: int) -> str:
+    return f"strava:geometry:{segment_id}"
+
+
+def claim_key(segment_id: int) -> str:
+    return f"enrichment:claim:{segment_id}"
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.ENRICHMENT_WORKERS, thread_name_prefix="enrichment"
+        )
+    return _executor
+
+
+def tolerance(zoom: int, latitude: float) -> float:
+    """GEOMETRY_TOLERANCE_PX map pixels at zoom, in degrees of latitude."""
+    pixel = 360.0 / (256 * 2**zoom) * math.cos(math.radians(latitude))
+    return pixel * settings.GEOMETRY_TOLERANCE_PX
+
+
+def elevation_profile(distance: Sequence[float], altitude: Sequence[float]) -> list[float]:
+    """Altitudes at GEOMETRY_PROFILE_POINTS evenly spaced distances."""
+    distance = np.asarray(distance, dtype=float)
+    at = np.linspace(distance[0], distance[-1], settings.GEOMETRY_PROFILE_POINTS)
+    return np.round(np.interp(at, distance, np.asarray(altitude, dtype=float)), 1).tolist()
+
+
+def build_geometry(encoded: str, profile: list[float] | None) -> dict:
+    """The Redis entry for a segment: its line simplified per zoom level."""
+    points = polyline.decode(encoded) if encoded else np.empty((0, 2))
+    levels = {}
+    if len(points):
+        latitude = float(points[:, 0].mean())
+        for zoom in settings.GEOMETRY_ZOOMS:
+            levels[str(zoom)] = polyline.encode(geo.simplify(points, tolerance(zoom, latitude)))
+    return {"polylines": levels, "elevation": profile or []}
+
+
+def _cache_geometry(segment_id: int, entry: dict) -> None:
+    cache.set(geometry_key(segment_id), orjson.dumps(entry), timeout=settings.SEGMENT_GEOMETRY_TTL)
+
+
+def enrich_segment(segment_id: int) -> None:
+    """Fetch one segment's streams and store its geometry."""
+    if cache.get(PAUSED_KEY):
+        return
+    try:
+        client = get_client("background")
+    except StravaRateLimited as e:
+        logger.warning(f"enrichment: background budget exhausted, pausing {e.retry_after}s")
+        cache.set(PAUSED_KEY, 1, timeout=e.retry_after)
+        # Let the segment be queued again once the budget is back
+        cache.delete(claim_key(segment_id))
+        return
+    streams = client.get_segment_streams(segment_id, types=["latlng", "distance", "altitude"])
+
+    latlng = streams.get("latlng")
+    encoded = polyline.encode(latlng.data) if latlng and latlng.data else ""
+    distance, altitude = streams.get("distance"), streams.get("altitude")
+    profile = None
+    if distance and altitude and distance.data and altitude.data:
+        profile = elevation_profile(distance.data, altitude.data)
+
+    Segment.objects.filter(strava_id=segment_id).update(
+        polyline=encoded, elevation_profile=profile, enriched_at=timezone.now()
+    )
+    _cache_geometry(segment_id, build_geometry(encoded, profile))
+    logger.info(f"enrichment: segment {segment_id}, {len(latlng.data) if encoded else 0} points")
+
+
+def _run(segment_id: int) -> None:
+    global _pending
+    try:
+        enrich_segment(segment_id)
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+
+async def aenqueue(segment_ids: Sequence[int]) -> int:
+    """Queue segments for enrichment, skipping ones queued in the last
+    ENRICHMENT_RETRY_AFTER seconds. At most ENRICHMENT_MAX_PENDING wait at
+    once; the rest are picked up by a later search. Returns how many were
+    queued."""
+    global _pending
+    if not segment_ids or await aiocache.get(PAUSED_KEY):
+        return 0
+    queued = 0
+    for segment_id in segment_ids:
+        with _pending_lock:
+            if _pending >= settings.ENRICHMENT_MAX_PENDING:
+                break
+        if not await aiocache.add(claim_key(segment_id), 1, settings.ENRICHMENT_RETRY_AFTER):
+            continue
+        with _pending_lock:
+            _pending += 1
+        get_executor().submit(background.task(_run, segment_id))
+        queued += 1
+    return queued
+
+
+def _level(entry: dict, zoom: int) -> str | None:
+    """The first simplification at or above zoom, or the finest one."""
+    levels = entry["polylines"]
+    if not levels:
+        return None
+    zooms = sorted(int(z) for z in levels)
+    return levels[str(next((z for z in zooms if z >= zoom), zooms[-1]))]
+
+
+async def aget_geometry(segment_ids: Sequence[int], zoom: int) -> dict[int, dict]:
+    """Map geometry for the segments that have it: {"polyline", "elevation"}
+    per segment id, with the polyline simplified for zoom. Segments without
+    it are queued for enrichment and left out."""
+    ids = list(dict.fromkeys(segment_ids))
+    if not ids:
+        return {}
+    cached = await aiocache.get_many([geometry_key(i) for i in ids])
+    entries = {i: orjson.loads(cached[geometry_key(i)]) for i in ids if geometry_key(i) in cached}
+
+    missing = [i for i in ids if i not in entries]
+    if missing:
+        # Enriched before but evicted from Redis: rebuild from the DB row
+        rows = Segment.objects.filter(strava_id__in=missing, enriched_at__isnull=False)
+        async for strava_id, encoded, profile in rows.values_list(
+            "strava_id", "polyline", "elevation_profile"
+        ):
+            entries[strava_id] = build_geometry(encoded, profile)
+            await aiocache.set(
+                geometry_key(strava_id), orjson.dumps(entries[strava_id]), settings.SEGMENT_GEOMETRY_TTL
+            )
+        missing = [i for i in missing if i not in entries]
+        if missing:
+            await aenqueue(missing)
+
+    return {
+        i: {"polyline": _level(entry, zoom), "elevation": entry["elevation"]}
+        for i, entry in entries.items()
+    }
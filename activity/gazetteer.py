@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+
+from activity.schemas import CoorsSchema
+
+logger = logging.getLogger(__name__)
+
+# File layout (little-endian):
+#   header: magic, format version, record count
+#   records: (name hash, latitude, longitude, population), sorted by hash
+# Records are fixed size so a lookup is a binary search straight over the
+# memory map; the kernel shares the mapped pages between worker processes.
+MAGIC = b"NCGZ"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+RECORD = struct.Struct("<QffI")
+
+
+def name_hash(normalized_name: str) -> int:
+    digest = hashlib.blake2b(normalized_name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def write_gazetteer(path: str, places: dict[str, tuple[float, float, int]]) -> int:
+    """Write normalized name -> (lat, lon, population) to a gazetteer file."""
+    records = sorted(
+        (name_hash(name), lat, lon, population)
+        for name, (lat, lon, population) in places.items()
+    )
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        for record in records:
+            f.write(RECORD.pack(*record))
+    # Swap atomically so running workers never map a half-written file
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class Gazetteer:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} gazetteer file")
+
+    def _hash_at(self, i: int) -> int:
+        return struct.unpack_from("<Q", self._map, HEADER.size + i * RECORD.size)[0]
+
+    def lookup(self, normalized_name: str) -> CoorsSchema | None:
+        target = name_hash(normalized_name)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._hash_at(lo) != target:
+            return None
+        _, lat, lon, _ = RECORD.unpack_from(self._map, HEADER.size + lo * RECORD.size)
+        return CoorsSchema(latitude=lat, longitude=lon)
+
+
+_gazetteer: Gazetteer | None = None
+_loaded = False
+_load_lock = threading.Lock()
+
+
+def get_gazetteer() -> Gazetteer | None:
+    """The process-wide gazetteer, mapped on first use. None when no file
+    is configured or it can't be read, in which case geocoding just goes to
+    the network as before."""
+    global _gazetteer, _loaded
+    if _loaded:
+        return _gazetteer
+    with _load_lock:
+        if not _loaded:
+            path = settings.GAZETTEER_PATH
+            if path and os.path.exists(path):
+                try:
+                    _gazetteer = Gazetteer(str(path))
+                    logger.info(f"gazetteer: mapped {_gazetteer.count} names from {path}")
+                except (OSError, ValueError):
+                    logger.exception(f"gazetteer: could not load {path}")
+            _loaded = True
+    return _gazetteer
+
+
+def lookup_place(normalized_name: str) -> CoorsSchema | None:
+    gazetteer = get_gazetteer()
+    if gazetteer is None:
+        return None
+    return gazetteer.lookup(normalized_name)
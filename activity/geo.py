@@ -0,0 +1,106 @@
+"""Closed-form spherical geometry over NumPy arrays.
+
+Every routine takes scalars or arrays and broadcasts, so a search can box,
+measure and filter a whole result set in one call instead of looping over
+segments. A spherical earth is within ~0.5% of the WGS-84 ellipsoid, which
+is plenty for search radii.
+"""
+
+from collections.abc import Iterable, Sequence
+
+import numpy as np
+
+EARTH_RADIUS_MILES = 3958.7613
+
+
+def bounding_boxes(lats, lons, radii_miles) -> np.ndarray:
+    """(sw_lat, sw_lon, ne_lat, ne_lon) rows for boxes whose edges are
+    radius miles north, south, east and west of each center."""
+    lats, lons, radii = np.broadcast_arrays(
+        np.asarray(lats, dtype=float),
+        np.asarray(lons, dtype=float),
+        np.asarray(radii_miles, dtype=float),
+    )
+    dlat = np.degrees(radii / EARTH_RADIUS_MILES)
+    # Meridians converge toward the poles, so a mile spans more longitude
+    cos_lat = np.maximum(np.cos(np.radians(lats)), 1e-6)
+    dlon = np.minimum(dlat / cos_lat, 180.0)
+    return np.stack(
+        [
+            np.clip(lats - dlat, -90.0, 90.0),
+            lons - dlon,
+            np.clip(lats + dlat, -90.0, 90.0),
+            lons + dlon,
+        ],
+        axis=-1,
+    )
+
+
+def bounding_box(lat: float, lon: float, radius_miles: float) -> tuple[float, float, float, float]:
+    sw_lat, sw_lon, ne_lat, ne_lon = bounding_boxes(lat, lon, radius_miles).tolist()
+    return sw_lat, sw_lon, ne_lat, ne_lon
+
+
+def haversine_miles(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Great-circle distance between points, broadcasting over arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def in_bounds(points: np.ndarray, bounds: Sequence[float]) -> np.ndarray:
+    """Mask of the (lat, lon) rows of points inside (sw_lat, sw_lon, ne_lat, ne_lon)."""
+    sw_lat, sw_lon, ne_lat, ne_lon = bounds
+    lats, lons = points[:, 0], points[:, 1]
+    return (sw_lat <= lats) & (lats <= ne_lat) & (sw_lon <= lons) & (lons <= ne_lon)
+
+
+def segment_points(segments: Iterable[dict]) -> tuple[np.ndarray, np.ndarray]:
+    """Start and end points of search payload segments as (n, 2) arrays."""
+    segments = list(segments)
+    starts = np.array([s["start_latlng"] for s in segments], dtype=float).reshape(-1, 2)
+    ends = np.array([s["end_latlng"] for s in segments], dtype=float).reshape(-1, 2)
+    return starts, ends
+
+
+def touching_bounds(segments: Sequence[dict], bounds: Sequence[float]) -> list[dict]:
+    """The segments that start or end inside bounds."""
+    if not segments:
+        return []
+    starts, ends = segment_points(segments)
+    mask = in_bounds(starts, bounds) | in_bounds(ends, bounds)
+    return [s for s, keep in zip(segments, mask.tolist()) if keep]
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker: drop the points of a line that lie within tolerance
+    degrees of the simplified line. Longitudes are scaled by the cosine of
+    the mean latitude first so the tolerance means the same on both axes."""
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3:
+        return points
+    projected = points * np.array([1.0, np.cos(np.radians(points[:, 0].mean()))])
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = projected[start], projected[end]
+        inner = projected[start + 1 : end] - a
+        ab = b - a
+        length = np.hypot(ab[0], ab[1])
+        if length == 0:
+            distance = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distance = np.abs(ab[0] * inner[:, 1] - ab[1] * inner[:, 0]) / length
+        i = int(np.argmax(distance))
+        if distance[i] > tolerance:
+            farthest = start + 1 + i
+            keep[farthest] = True
+            stack.extend([(start, farthest), (farthest, end)])
+    return points[keep]
@@ -0,0 +1,154 @@
+"""Per-process L1 caches in front of Redis, kept coherent with pub/sub.
+
+Every write to a Redis key that an L1 mirrors is followed by a message on
+INVALIDATION_CHANNEL, and a listener thread in each process drops the key
+from its own L1s. If the listener loses its connection it may have missed
+messages, so it clears every L1 when it resubscribes; entries also carry a
+TTL as a last line of defence.
+
+Hit/miss counts per tier are kept in process memory so an L1 hit never
+waits on Redis; the listener thread flushes them into the shared metrics
+counters every L1_STATS_FLUSH_INTERVAL seconds.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from collections.abc import Callable, Iterable
+
+import orjson
+from django.conf import settings
+
+from activity import aiocache, metrics
+from activity.lru import LRUCache
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "nextclimb:cache:invalidate"
+
+TIER_STATS = [
+    f"cache.{namespace}.{tier}.{outcome}"
+    for namespace in ("segments", "geocode")
+    for tier in ("l1", "redis")
+    for outcome in ("hit", "miss")
+] + [
+    # Hits that were negative entries: empty tiles, unresolvable places
+    "cache.segments.negative.hit",
+    "cache.geocode.negative.hit",
+    # Upstream calls skipped while a failed key backs off
+    "backoff.segments.blocked",
+    "backoff.geocode.blocked",
+]
+
+# Tells our own messages apart from other processes'
+_origin = uuid.uuid4().hex
+# (cache key prefix, L1, maps a cache key to the L1's key)
+_tiers: list[tuple[str, LRUCache, Callable[[str], str]]] = []
+
+_listener_pid: int | None = None
+_listener_lock = threading.Lock()
+
+_stats: Counter[str] = Counter()
+_stats_lock = threading.Lock()
+_stats_flushed_at = time.monotonic()
+
+
+def register(prefix: str, lru: LRUCache, local_key: Callable[[str], str] = lambda key: key) -> None:
+    """Mirror the Redis keys starting with prefix in lru."""
+    _tiers.append((prefix, lru, local_key))
+
+
+def _drop(keys: Iterable[str]) -> None:
+    for key in keys:
+        for prefix, lru, local_key in _tiers:
+            if key.startswith(prefix):
+                lru.delete(local_key(key))
+
+
+def _message(keys: list[str]) -> bytes:
+    return orjson.dumps({"origin": _origin, "keys": keys})
+
+
+def publish(keys: list[str]) -> None:
+    """Tell the other processes these keys changed in Redis."""
+    client = aiocache.get_django_redis()
+    if client is None or not keys:
+        return
+    try:
+        client.get_client().publish(INVALIDATION_CHANNEL, _message(keys))
+    except Exception:
+        logger.exception("l1: failed to publish invalidation")
+
+
+async def apublish(keys: list[str]) -> None:
+    if not keys:
+        return
+    try:
+        await aiocache.publish(INVALIDATION_CHANNEL, _message(keys))
+    except Exception:
+        logger.exception("l1: failed to publish invalidation")
+
+
+def _listen() -> None:
+    backoff = 1.0
+    while True:
+        try:
+            pubsub = aiocache.get_django_redis().get_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Anything could have changed while we weren't subscribed
+            for _, lru, _ in _tiers:
+                lru.clear()
+            backoff = 1.0
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    payload = orjson.loads(message["data"])
+                    if payload["origin"] != _origin:
+                        _drop(payload["keys"])
+                if time.monotonic() - _stats_flushed_at > settings.L1_STATS_FLUSH_INTERVAL:
+                    flush_stats()
+        except Exception:
+            logger.exception(f"l1: invalidation listener failed, retrying in {backoff:.0f}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+
+def ensure_listener() -> None:
+    """Start this process's listener thread, once per process."""
+    global _listener_pid
+    if _listener_pid == os.getpid() or aiocache.get_django_redis() is None:
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            threading.Thread(target=_listen, name="l1-invalidation", daemon=True).start()
+            _listener_pid = os.getpid()
+
+
+def record(name: str, amount: int = 1) -> None:
+    """Count one of TIER_STATS, e.g. record("cache.segments.l1.hit")."""
+    if amount > 0:
+        with _stats_lock:
+            _stats[name] += amount
+
+
+def flush_stats() -> None:
+    """Move this process's counts into the shared metrics counters."""
+    global _stats_flushed_at
+    with _stats_lock:
+        pending = dict(_stats)
+        _stats.clear()
+        _stats_flushed_at = time.monotonic()
+    for name, count in pending.items():
+        metrics.incr(name, count)
+
+
+def get_tier_stats() -> dict[str, int]:
+    """Shared hit/miss totals plus this process's counts not yet flushed."""
+    totals = metrics.get_metrics(TIER_STATS)
+    with _stats_lock:
+        for name, count in _stats.items():
+            totals[name] = totals.get(name, 0) + count
+    return totals
@@ -0,0 +1,62 @@
+import csv
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from activity.gazetteer import write_gazetteer
+from activity.utils import normalize_query
+
+csv.field_size_limit(sys.maxsize)
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the offline gazetteer from a GeoNames cities dump "
+        "(e.g. cities15000.txt from https://download.geonames.org/export/dump/)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("cities", help="GeoNames cities file")
+        parser.add_argument(
+            "--admin1", help="GeoNames admin1CodesASCII.txt, adds state/region names"
+        )
+        parser.add_argument("--output", default=str(settings.GAZETTEER_PATH))
+
+    def handle(self, *args, **options):
+        admin1_names: dict[str, str] = {}
+        if options["admin1"]:
+            with open(options["admin1"], encoding="utf-8") as f:
+                for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+                    admin1_names[row[0]] = row[2]  # "US.CA" -> "California"
+
+        places: dict[str, tuple[float, float, int]] = {}
+
+        def add(name: str, lat: float, lon: float, population: int) -> None:
+            key = normalize_query(name)
+            # Ambiguous names resolve to the most populous place, the same
+            # way a person would read "san jose" or "paris"
+            if key and (key not in places or places[key][2] < population):
+                places[key] = (lat, lon, population)
+
+        with open(options["cities"], encoding="utf-8") as f:
+            for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+                name, ascii_name = row[1], row[2]
+                lat, lon = float(row[4]), float(row[5])
+                country, admin1 = row[8], row[10]
+                population = int(row[14] or 0)
+                admin1_name = admin1_names.get(f"{country}.{admin1}", "")
+
+                for base in {name, ascii_name}:
+                    # "san jose", "san jose ca", "san jose california",
+                    # "san jose us", "san jose ca us", ...
+                    add(base, lat, lon, population)
+                    add(f"{base} {country}", lat, lon, population)
+                    for region in filter(None, (admin1, admin1_name)):
+                        add(f"{base} {region}", lat, lon, population)
+                        add(f"{base} {region} {country}", lat, lon, population)
+                        if country == "US":
+                            add(f"{base} {region} usa", lat, lon, population)
+
+        count = write_gazetteer(options["output"], places)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} names to {options['output']}"))
@@ -0,0 +1,99 @@
+import pickle
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from redis.exceptions import ResponseError
+
+from activity.clients import get_connection_stats
+from activity.codec import COMPRESSIONS, available_compression, encode_segments
+from activity.l1 import get_tier_stats
+from activity.utils import get_cached_segments
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure Redis memory per cached tile and compare the pickled "
+        "list-of-dicts encoding with each activity.codec compression; also "
+        "reports upstream connection reuse and cache tier hit rates"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sample", type=int, default=500, help="Tiles to measure")
+
+    def handle(self, *args, **options):
+        if not hasattr(cache, "iter_keys"):
+            raise CommandError("The default cache must be django-redis")
+        redis = cache.client.get_client()
+        self.report_connections()
+        self.report_tiers()
+
+        keys = []
+        for key in cache.iter_keys("strava:tile:*"):
+            keys.append(key)
+            if len(keys) >= options["sample"]:
+                break
+        if not keys:
+            self.stdout.write("No cached tiles to measure")
+            return
+
+        segments, _ = get_cached_segments(keys)
+        if not segments:
+            self.stdout.write(f"None of the {len(keys)} sampled tiles could be decoded")
+            return
+        try:
+            in_redis = [redis.memory_usage(cache.make_key(k)) or 0 for k in keys]
+        except ResponseError:
+            # Some managed Redis services disable MEMORY
+            in_redis = None
+        sizes: dict[str, list[int]] = {"pickle": []}
+        compressions = [c for c in COMPRESSIONS if available_compression(c) == c]
+        for data in segments.values():
+            # What set_cached_segments stored before the codec
+            sizes["pickle"].append(
+                len(pickle.dumps({"data": data, "fresh_until": 0.0}, pickle.HIGHEST_PROTOCOL))
+            )
+            for compression in compressions:
+                sizes.setdefault(compression, []).append(
+                    len(encode_segments(data, 0.0, compression))
+                )
+
+        count = len(segments)
+        total_segments = sum(len(d) for d in segments.values())
+        self.stdout.write(f"{count} tiles, {total_segments / count:.1f} segments per tile")
+        if in_redis is not None:
+            self.stdout.write(f"Redis MEMORY USAGE as stored now: {sum(in_redis) / len(keys):.0f} B/key")
+        baseline = sum(sizes["pickle"]) / count
+        for name, values in sizes.items():
+            average = sum(values) / count
+            self.stdout.write(
+                f"  {name:<7} {average:8.0f} B/key payload  {average / baseline:6.1%} of pickle"
+            )
+
+    def report_connections(self):
+        """How often each upstream service reused a pooled connection."""
+        self.stdout.write("Upstream connections:")
+        for service, stats in get_connection_stats().items():
+            reused = stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+            self.stdout.write(
+                f"  {service:<10} {stats['requests']:8d} requests  "
+                f"{stats['connections']:6d} connections  {reused:6.1%} reused"
+            )
+
+    def report_tiers(self):
+        """Hit rates of the L1 and Redis tiers, from activity.l1's counters."""
+        stats = get_tier_stats()
+        self.stdout.write("Cache tiers:")
+        for namespace in ("segments", "geocode"):
+            for tier in ("l1", "redis"):
+                hits = stats[f"cache.{namespace}.{tier}.hit"]
+                misses = stats[f"cache.{namespace}.{tier}.miss"]
+                rate = hits / (hits + misses) if hits + misses else 0.0
+                self.stdout.write(
+                    f"  {namespace:<8} {tier:<5} {hits:8d} hits  {misses:8d} misses  "
+                    f"{rate:6.1%} hit"
+                )
+            negative = stats[f"cache.{namespace}.negative.hit"]
+            blocked = stats[f"backoff.{namespace}.blocked"]
+            self.stdout.write(
+                f"  {namespace:<8} {negative} negative hits, {blocked} calls held back by backoff"
+            )
@@ -0,0 +1,61 @@
+import logging
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from activity.warming import warm_cache
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Pre-fill the segment tile cache for the most searched areas, within "
+        "a Strava call budget. With --every, keeps running on that interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--budget", type=int, help="Max Strava calls per run")
+        parser.add_argument("--days", type=int, help="Count demand over this many days")
+        parser.add_argument(
+            "--ahead", type=int, help="Refetch tiles expiring within this many seconds"
+        )
+        parser.add_argument(
+            "--every", type=int, help="Run every this many seconds instead of once"
+        )
+
+    def handle(self, *args, **options):
+        if not options["every"]:
+            self.warm(options)
+            return
+        while True:
+            try:
+                # With several replicas running the scheduler only one warms per interval
+                if cache.add("warm_segment_cache:lock", 1, timeout=max(options["every"] - 1, 1)):
+                    self.warm(options)
+            except Exception:
+                # One bad run mustn't stop the scheduler
+                logger.exception("warm: run failed, trying again next interval")
+            time.sleep(options["every"])
+
+    def warm(self, options) -> None:
+        self.report(
+            warm_cache(budget=options["budget"], days=options["days"], ahead=options["ahead"])
+        )
+
+    def report(self, report: dict) -> None:
+        self.stdout.write(
+            f"{report['areas']} areas ({report['unresolved']} never geocoded), "
+            f"{report['tiles']} tiles, {report['due']} missing or expiring"
+        )
+        self.stdout.write(
+            f"Warmed {report['warmed']} tiles with {report['calls']} Strava calls"
+            + (f", {report['failed']} failed" if report["failed"] else "")
+            + (" before hitting the rate limit" if report["rate_limited"] else "")
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Coverage {report['coverage_before']:.0%} -> {report['coverage_after']:.0%}"
+            )
+        )
@@ -0,0 +1,40 @@
+import logging
+from collections.abc import Iterable
+
+from django.core.cache import cache
+
+from activity import aiocache
+
+logger = logging.getLogger(__name__)
+
+
+def metric_key(name: str) -> str:
+    return f"metrics:{name}"
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """Bump a shared counter in Redis. Metrics must never break a request."""
+    if amount <= 0:
+        return
+    key = metric_key(name)
+    try:
+        # add() is a no-op when the counter already exists
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, amount)
+    except Exception:
+        logger.exception(f"metrics: failed to increment {name}")
+
+
+async def aincr(name: str, amount: int = 1) -> None:
+    if amount <= 0:
+        return
+    try:
+        await aiocache.incr(metric_key(name), amount)
+    except Exception:
+        logger.exception(f"metrics: failed to increment {name}")
+
+
+def get_metrics(names: Iterable[str]) -> dict[str, int]:
+    names = list(names)
+    values = cache.get_many([metric_key(n) for n in names])
+    return {n: values.get(metric_key(n), 0) for n in names}
@@ -0,0 +1,47 @@
+# Generated by Django 6.1.2 on 2026-10-18 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity', '0005_add_emailsignup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExploredTile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.IntegerField()),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('explored_at', models.DateTimeField()),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('zoom', 'x', 'y'), name='unique_explored_tile')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('strava_id', models.BigIntegerField(unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('climb_category', models.IntegerField()),
+                ('climb_category_desc', models.CharField(max_length=32)),
+                ('avg_grade', models.FloatField()),
+                ('distance', models.FloatField()),
+                ('elev_difference', models.FloatField()),
+                ('start_lat', models.FloatField()),
+                ('start_lng', models.FloatField()),
+                ('end_lat', models.FloatField()),
+                ('end_lng', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['start_lat', 'start_lng'], name='activity_se_start_l_ba547d_idx')],
+            },
+        ),
+    ]
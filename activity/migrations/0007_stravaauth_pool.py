@@ -0,0 +1,33 @@
+# Generated by Django 6.1.2 on 2026-10-18 06:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity', '0006_segment_exploredtile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stravaauth',
+            name='client_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='stravaauth',
+            name='client_secret',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='stravaauth',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='stravaauth',
+            name='label',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
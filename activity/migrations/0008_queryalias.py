@@ -0,0 +1,25 @@
+# Generated by Django 6.1.2 on 2026-10-18 06:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity', '0007_stravaauth_pool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(max_length=255, unique=True)),
+                ('canonical', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'query aliases',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.1.2 on 2026-10-18 06:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity', '0008_queryalias'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='elevation_profile',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='enriched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='polyline',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('activity', '0009_segment_geometry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='segment',
+            index=models.Index(fields=['end_lat', 'end_lng'], name='activity_se_end_lat_9c7c5e_idx'),
+        ),
+    ]
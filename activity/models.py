@@ -10,17 +10,23 @@ class StravaAuth(models.Model):
     access_token = models.CharField(max_length=255)
     refresh_token = models.CharField(max_length=255)
     expires_at = models.BigIntegerField()  # Stores the POSIX timestamp
+    # Each pooled account is its own Strava app with its own rate limits.
+    # Blank credentials fall back to MY_STRAVA_CLIENT_ID/SECRET.
+    label = models.CharField(max_length=100, blank=True)
+    client_id = models.CharField(max_length=64, blank=True)
+    client_secret = models.CharField(max_length=255, blank=True)
+    is_active = models.BooleanField(default=True)
 
     def is_expired(self):
         """Checks if the current access token is still valid."""
         return time.time() > self.expires_at
 
-    def check_and_refresh(self, client):
+    def check_and_refresh(self, client, buffer=300):
         # Use a 5-minute (300s) buffer for safety
-        if timezone.now().timestamp() + 300 >= self.expires_at:
+        if timezone.now().timestamp() + buffer >= self.expires_at:
             res = client.refresh_access_token(
-                client_id=settings.MY_STRAVA_CLIENT_ID,
-                client_secret=settings.MY_STRAVA_CLIENT_SECRET,
+                client_id=self.client_id or settings.MY_STRAVA_CLIENT_ID,
+                client_secret=self.client_secret or settings.MY_STRAVA_CLIENT_SECRET,
                 refresh_token=self.refresh_token,
             )
             self.access_token = res["access_token"]
@@ -39,6 +45,16 @@ class GeocodedLocation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+class QueryAlias(models.Model):
+    # Another spelling of a GeocodedLocation.user_query, see activity/aliases.py
+    alias      = models.CharField(max_length=255, unique=True)
+    canonical  = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = "query aliases"
+
+
 class EmailSignup(models.Model):
     email      = models.EmailField(unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -50,3 +66,43 @@ class SearchFeedback(models.Model):
     vote       = models.BooleanField(null=True, blank=True)  # True = up, False = down, None = not voted
     comment    = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+
+
+class Segment(models.Model):
+    # Summary fields from Strava's explore endpoint, distance in meters
+    strava_id           = models.BigIntegerField(unique=True)
+    name                = models.CharField(max_length=255)
+    climb_category      = models.IntegerField()
+    climb_category_desc = models.CharField(max_length=32)
+    avg_grade           = models.FloatField()
+    distance            = models.FloatField()
+    elev_difference     = models.FloatField()
+    start_lat           = models.FloatField()
+    start_lng           = models.FloatField()
+    end_lat             = models.FloatField()
+    end_lng             = models.FloatField()
+    updated_at          = models.DateTimeField(auto_now=True)
+    # Filled in by activity/enrichment.py from the segment's streams:
+    # full-resolution encoded polyline and altitudes at even distances
+    polyline            = models.TextField(blank=True)
+    elevation_profile   = models.JSONField(null=True, blank=True)
+    enriched_at         = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["start_lat", "start_lng"]),
+            models.Index(fields=["end_lat", "end_lng"]),
+        ]
+
+
+class ExploredTile(models.Model):
+    # A slippy-map tile whose segments have been pulled from Strava
+    zoom        = models.IntegerField()
+    x           = models.IntegerField()
+    y           = models.IntegerField()
+    explored_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["zoom", "x", "y"], name="unique_explored_tile")
+        ]
@@ -0,0 +1,43 @@
+"""Google's encoded polyline format, which Strava and most map libraries use.
+
+Each coordinate is stored as the difference from the previous one, scaled
+to an integer and written in 5-bit chunks as printable characters, so a
+line costs a few bytes per point instead of two floats.
+"""
+
+from collections.abc import Iterable, Sequence
+
+import numpy as np
+
+
+def encode(points: Iterable[Sequence[float]], precision: int = 5) -> str:
+    """Encode (lat, lng) points."""
+    factor = 10**precision
+    chars: list[str] = []
+    prev_lat = prev_lng = 0
+    for lat, lng in points:
+        lat_i, lng_i = round(lat * factor), round(lng * factor)
+        for delta in (lat_i - prev_lat, lng_i - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        prev_lat, prev_lng = lat_i, lng_i
+    return "".join(chars)
+
+
+def decode(encoded: str, precision: int = 5) -> np.ndarray:
+    """The (lat, lng) points of an encoded polyline, as an (n, 2) array."""
+    deltas: list[int] = []
+    value = shift = 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1F) << shift
+        shift += 5
+        if chunk < 0x20:
+            deltas.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    if len(deltas) % 2:
+        raise ValueError("Truncated polyline")
+    return np.cumsum(np.array(deltas, dtype=np.int64).reshape(-1, 2), axis=0) / 10**precision
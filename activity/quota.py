@@ -0,0 +1,199 @@
+import logging
+import time
+from typing import Literal
+
+from django.conf import settings
+from django.core.cache import cache
+from stravalib.util.limiter import (
+    get_rates_from_response_headers,
+    get_seconds_until_next_day,
+    get_seconds_until_next_quarter,
+)
+
+from activity import aiocache
+
+logger = logging.getLogger(__name__)
+
+# User-facing searches may spend the whole budget, background work (refreshes,
+# warming, enrichment) only STRAVA_BACKGROUND_SHARE of it.
+Priority = Literal["user", "background"]
+
+SHORT_WINDOW = 15 * 60
+DAILY_WINDOW = 24 * 60 * 60
+
+
+def short_quota_key(auth_id: int) -> str:
+    return f"strava:quota:{auth_id}:15min"
+
+
+def daily_quota_key(auth_id: int) -> str:
+    return f"strava:quota:{auth_id}:daily"
+
+
+def short_sent_key(auth_id: int) -> str:
+    # Strava's windows are aligned to the quarter hour and to midnight UTC
+    return f"strava:sent:{auth_id}:15min:{int(time.time() // SHORT_WINDOW)}"
+
+
+def daily_sent_key(auth_id: int) -> str:
+    return f"strava:sent:{auth_id}:daily:{int(time.time() // DAILY_WINDOW)}"
+
+
+class QuotaRecorder:
+    """stravalib rate_limiter hook that stores each account's usage in Redis.
+
+    Strava reports usage and limits for the 15-minute and daily windows in
+    the response headers. The keys expire when Strava resets the window, so
+    a missing key means the full quota is available again.
+    """
+
+    def __init__(self, auth_id: int):
+        self.auth_id = auth_id
+
+    def _entries(self, headers, method: str) -> list[tuple[str, tuple[int, int], int]]:
+        rates = get_rates_from_response_headers(dict(headers), method)
+        if rates is None:
+            return []
+        return [
+            (
+                short_quota_key(self.auth_id),
+                (rates.short_usage, rates.short_limit),
+                max(get_seconds_until_next_quarter(), 1),
+            ),
+            (
+                daily_quota_key(self.auth_id),
+                (rates.long_usage, rates.long_limit),
+                max(get_seconds_until_next_day(), 1),
+            ),
+        ]
+
+    def __call__(self, headers: dict[str, str], method: str) -> None:
+        for key, value, timeout in self._entries(headers, method):
+            cache.set(key, value, timeout=timeout)
+
+    async def arecord(self, headers, method: str) -> None:
+        for key, value, timeout in self._entries(headers, method):
+            await aiocache.set(key, value, timeout)
+
+
+def _window_keys(auth_ids: list[int]) -> list[str]:
+    keys = []
+    for i in auth_ids:
+        keys += [short_quota_key(i), daily_quota_key(i), short_sent_key(i), daily_sent_key(i)]
+    return keys
+
+
+def _windows(auth_ids: list[int], found: dict) -> dict[int, tuple[int, int, int, int]]:
+    """(short usage, short limit, daily usage, daily limit) per account.
+
+    Usage is the larger of what Strava last reported and what we have sent
+    in the current window, since the headers lag behind in-flight calls.
+    """
+    windows = {}
+    for i in auth_ids:
+        short_usage, short_limit = found.get(short_quota_key(i), (0, settings.STRAVA_SHORT_LIMIT))
+        daily_usage, daily_limit = found.get(daily_quota_key(i), (0, settings.STRAVA_DAILY_LIMIT))
+        windows[i] = (
+            max(short_usage, found.get(short_sent_key(i), 0)),
+            short_limit,
+            max(daily_usage, found.get(daily_sent_key(i), 0)),
+            daily_limit,
+        )
+    return windows
+
+
+def _get_windows(auth_ids: list[int]) -> dict[int, tuple[int, int, int, int]]:
+    return _windows(auth_ids, cache.get_many(_window_keys(auth_ids)))
+
+
+async def _aget_windows(auth_ids: list[int]) -> dict[int, tuple[int, int, int, int]]:
+    return _windows(auth_ids, await aiocache.get_many(_window_keys(auth_ids)))
+
+
+def _budget(limit: int, priority: Priority) -> int:
+    if priority == "background":
+        return int(limit * settings.STRAVA_BACKGROUND_SHARE)
+    return limit
+
+
+def _remaining(windows: dict[int, tuple[int, int, int, int]], priority: Priority) -> dict[int, int]:
+    return {
+        i: min(_budget(short_limit, priority) - short_usage, _budget(daily_limit, priority) - daily_usage)
+        for i, (short_usage, short_limit, daily_usage, daily_limit) in windows.items()
+    }
+
+
+def get_remaining(auth_ids: list[int], priority: Priority = "user") -> dict[int, int]:
+    """Returns the requests each account has left in its tightest window."""
+    return _remaining(_get_windows(auth_ids), priority)
+
+
+async def aget_remaining(auth_ids: list[int], priority: Priority = "user") -> dict[int, int]:
+    return _remaining(await _aget_windows(auth_ids), priority)
+
+
+def _incr(key: str, timeout: int) -> int:
+    cache.add(key, 0, timeout=timeout)
+    return cache.incr(key)
+
+
+async def _aincr(key: str, timeout: int) -> int:
+    await aiocache.add(key, 0, timeout)
+    return await aiocache.incr(key)
+
+
+def _over_budget(
+    window: tuple[int, int, int, int], short_sent: int, daily_sent: int, priority: Priority
+) -> bool:
+    short_usage, short_limit, daily_usage, daily_limit = window
+    return (
+        max(short_sent, short_usage + 1) > _budget(short_limit, priority)
+        or max(daily_sent, daily_usage + 1) > _budget(daily_limit, priority)
+    )
+
+
+def reserve(auth_id: int, priority: Priority = "user") -> bool:
+    """Claim one request from the account's current windows.
+
+    The claim is an atomic Redis INCR, so workers on every host draw from
+    the same budget. Claims that would exceed the budget are handed back and
+    the call is refused instead of being sent to Strava to be rejected.
+    """
+    window = _get_windows([auth_id])[auth_id]
+    short_sent = _incr(short_sent_key(auth_id), SHORT_WINDOW + 60)
+    daily_sent = _incr(daily_sent_key(auth_id), DAILY_WINDOW + 60)
+    if _over_budget(window, short_sent, daily_sent, priority):
+        cache.decr(short_sent_key(auth_id))
+        cache.decr(daily_sent_key(auth_id))
+        return False
+    return True
+
+
+async def areserve(auth_id: int, priority: Priority = "user") -> bool:
+    window = (await _aget_windows([auth_id]))[auth_id]
+    short_sent = await _aincr(short_sent_key(auth_id), SHORT_WINDOW + 60)
+    daily_sent = await _aincr(daily_sent_key(auth_id), DAILY_WINDOW + 60)
+    if _over_budget(window, short_sent, daily_sent, priority):
+        await aiocache.incr(short_sent_key(auth_id), -1)
+        await aiocache.incr(daily_sent_key(auth_id), -1)
+        return False
+    return True
+
+
+def get_retry_after(auth_ids: list[int], priority: Priority = "user") -> int:
+    """Seconds until the soonest window reset that frees up an account."""
+    return _retry_after(_get_windows(auth_ids), priority)
+
+
+async def aget_retry_after(auth_ids: list[int], priority: Priority = "user") -> int:
+    return _retry_after(await _aget_windows(auth_ids), priority)
+
+
+def _retry_after(windows: dict[int, tuple[int, int, int, int]], priority: Priority) -> int:
+    daily_exhausted = all(
+        daily_usage >= _budget(daily_limit, priority)
+        for _, _, daily_usage, daily_limit in windows.values()
+    )
+    if daily_exhausted:
+        return get_seconds_until_next_day()
+    return get_seconds_until_next_quarter()
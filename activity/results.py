@@ -0,0 +1,114 @@
+"""Server-side filtering, sorting and pagination of search results.
+
+The merged tile set is turned into column arrays once, and the radius
+check, filters, sort and cursor are all evaluated over those columns.
+"""
+
+import base64
+import binascii
+import json
+
+import numpy as np
+
+from activity import geo
+from activity.difficulty import DIFFICULTY_LEVELS
+from activity.schemas import CoorsSchema, SearchPayloadSchema
+
+_DIFFICULTY_RANK = {label: rank for rank, label in enumerate(DIFFICULTY_LEVELS)}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sort: str, key: list[float]) -> str:
+    raw = json.dumps([sort, *key], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> list[float]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, *key = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if cursor_sort != sort:
+        raise InvalidCursor("Cursor was issued for a different sort order")
+    # Keys are compared against numeric columns, so anything else is malformed
+    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in key):
+        raise InvalidCursor("Invalid cursor")
+    return key
+
+
+def _after(columns: list[np.ndarray], key: list[float]) -> np.ndarray:
+    """Mask of rows that sort strictly after key, comparing columns in order."""
+    after = np.zeros(len(columns[0]), dtype=bool)
+    for column, value in reversed(list(zip(columns, key))):
+        after = (column > value) | ((column == value) & after)
+    return after
+
+
+def filter_segments(
+    segments: list[dict], center: CoorsSchema, query: SearchPayloadSchema
+) -> dict:
+    """Apply the query's radius, filters, sort and page to merged segments.
+
+    Returns the page of segments, the number that matched and the cursor
+    for the next page (None on the last one).
+    """
+    if not segments:
+        return {"segments": [], "total": 0, "next_cursor": None}
+
+    starts, ends = geo.segment_points(segments)
+    # A segment is in range if it starts or ends within the radius
+    from_center = np.minimum(
+        geo.haversine_miles(center.latitude, center.longitude, starts[:, 0], starts[:, 1]),
+        geo.haversine_miles(center.latitude, center.longitude, ends[:, 0], ends[:, 1]),
+    )
+    rank = np.array([_DIFFICULTY_RANK[s["difficulty"]] for s in segments])
+    grade = np.array([s["avg_grade"] for s in segments], dtype=float)
+    distance = np.array([s["distance"] for s in segments], dtype=float)
+    ids = np.array([s["id"] for s in segments], dtype=float)
+
+    mask = from_center <= query.radius
+    if query.difficulty:
+        mask &= np.isin(rank, [_DIFFICULTY_RANK[d] for d in query.difficulty])
+    if query.min_grade is not None:
+        mask &= grade >= query.min_grade
+    if query.max_grade is not None:
+        mask &= grade <= query.max_grade
+    if query.min_distance is not None:
+        mask &= distance >= query.min_distance
+    if query.max_distance is not None:
+        mask &= distance <= query.max_distance
+    total = int(mask.sum())
+
+    # Sort columns, most significant first; the id makes the order total so
+    # a cursor always points at exactly one position.
+    if query.sort == "distance":
+        columns = [from_center, ids]
+    elif query.sort == "difficulty":
+        columns = [rank.astype(float), from_center, ids]
+    else:
+        columns = [-rank.astype(float), from_center, ids]
+
+    if query.cursor:
+        key = decode_cursor(query.cursor, query.sort)
+        if len(key) != len(columns):
+            raise InvalidCursor("Invalid cursor")
+        mask &= _after(columns, key)
+
+    rows = np.flatnonzero(mask)
+    # lexsort treats its last key as the primary one
+    rows = rows[np.lexsort([c[rows] for c in reversed(columns)])]
+
+    next_cursor = None
+    if query.limit is not None and len(rows) > query.limit:
+        rows = rows[: query.limit]
+        next_cursor = encode_cursor(query.sort, [c[rows[-1]].item() for c in columns])
+
+    return {
+        "segments": [segments[i] for i in rows.tolist()],
+        "total": total,
+        "next_cursor": next_cursor,
+    }
@@ -1,7 +1,9 @@
-from typing import Annotated, Any
+from typing import Annotated, Any, Literal
 
 from ninja import Schema
-from pydantic import BeforeValidator, EmailStr
+from pydantic import BeforeValidator, EmailStr, Field
+
+from activity.difficulty import Difficulty, classify
 
 
 def unwrap_latlon(v: Any) -> tuple[float, float]:
@@ -19,7 +21,6 @@ def unwrap_latlon(v: Any) -> tuple[float, float]:
 # Create a reusable type for coordinates
 LatLonSchema = Annotated[tuple[float, float], BeforeValidator(unwrap_latlon)]
 
-
 class SegmentBoundsSchema(Schema):
     sw_lat: float
     sw_lon: float
@@ -39,6 +40,26 @@ class CoorsSchema(Schema):
 class SearchPayloadSchema(Schema):
     location: str
     radius: int
+    # Optional filters, applied after segments are limited to the radius
+    difficulty: list[Difficulty] | None = None
+    min_grade: float | None = None
+    max_grade: float | None = None
+    min_distance: float | None = None  # miles
+    max_distance: float | None = None  # miles
+    # nearest first, easiest first or hardest first
+    sort: Literal["distance", "difficulty", "-difficulty"] = "distance"
+    # Page size; all matching segments when unset
+    limit: int | None = Field(None, ge=1, le=500)
+    cursor: str | None = None
+    # Map zoom to include segment polylines and elevation profiles for
+    zoom: int | None = Field(None, ge=0, le=22)
+    # Send segments as they are found instead of one page, as newline
+    # delimited JSON or server-sent events
+    stream: Literal["ndjson", "sse"] | None = None
+
+
+class SearchBatchRequest(Schema):
+    queries: list[SearchPayloadSchema] = Field(..., min_length=1, max_length=10)
 
 
 class ExplorerSegment(Schema):
@@ -60,39 +81,8 @@ class ExplorerSegment(Schema):
         return round(self.disance / 1000, 1)
 
     def get_difficulty(self) -> str:
-        distance_km = self.distance / 1000
-        gain_m = abs(self.elev_difference)
-        avg_grade = abs(self.avg_grade)
-
-        # 1. Base Score: (Gain is the foundation)
-        score = gain_m * 1.0
-
-        # 2. Steepness Multiplier:
-        # If it's over 8%, every bit of grade hurts significantly more
-        if avg_grade > 8:
-            score += (avg_grade**2) * 2  # Exponential pain for steepness
-        else:
-            score += avg_grade * 15
-
-        # 3. Sustained Effort:
-        # Distance adds "fatigue," but we cap it so a flat 50km ride
-        # doesn't get rated as "Brutal"
-        score += min(distance_km * 25, 300)
-
-        # 4. Overrides (The "Beginner Wall")
-        if avg_grade >= 15:
-            score += 300  # "The Wall" override
-        if gain_m > 500:
-            score += 200  # "Big Mountain" override
-
-        # 5. Beginner-Centric Labels
-        if score < 150:
-            return "Easy"
-        if score < 400:
-            return "Moderate"
-        if score < 800:
-            return "Hard"
-        return "Brutal"
+        # Scores a single segment; use activity.difficulty.classify for many
+        return classify([self.distance], [self.elev_difference], [self.avg_grade])[0]
 
     class Config:
         from_attributes = True
@@ -101,12 +91,34 @@ class ExplorerSegment(Schema):
 class SearchResponseSchema(Schema):
     id: int
     name: str
-    difficulty: str
+    difficulty: Difficulty
     distance: float
     avg_grade: float
     start_latlng: LatLonSchema
     end_latlng: LatLonSchema
     elev_difference: float
+    # Only with a zoom, and null until the segment's geometry is fetched
+    polyline: str | None = None
+    elevation: list[float] | None = None
+
+
+class SearchPageSchema(Schema):
+    source: Literal["strava", "cached"]
+    segments: list[SearchResponseSchema]
+    # Segments matching the query, across all pages
+    total: int
+    next_cursor: str | None = None
+    # Some tiles couldn't be fetched from Strava and are missing
+    partial: bool = False
+
+
+class LocationSuggestQuery(Schema):
+    q: str
+    limit: int = Field(10, ge=1, le=50)
+
+
+class LocationSuggestResponse(Schema):
+    suggestions: list[str]
 
 
 class FeedbackRequest(Schema):
@@ -0,0 +1,134 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from activity import geo
+from activity.models import ExploredTile, Segment
+from activity.schemas import ExplorerSegment, SegmentBoundsSchema
+from activity.utils import (
+    Tile,
+    generate_tile_cache_key,
+    get_tile_bounds,
+    to_search_segments,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _max_age(segments: list[dict]) -> int:
+    # An empty tile is a negative entry and lasts no longer than in Redis
+    return settings.SEGMENT_INDEX_MAX_AGE if segments else settings.SEGMENT_EMPTY_TTL
+
+
+def segment_to_explorer(segment: Segment) -> ExplorerSegment:
+    return ExplorerSegment(
+        id=segment.strava_id,
+        name=segment.name,
+        climb_category=segment.climb_category,
+        climb_category_desc=segment.climb_category_desc,
+        avg_grade=segment.avg_grade,
+        distance=segment.distance,
+        start_latlng=(segment.start_lat, segment.start_lng),
+        end_latlng=(segment.end_lat, segment.end_lng),
+        elev_difference=segment.elev_difference,
+    )
+
+
+def _in_bounds(prefix: str, b: SegmentBoundsSchema) -> Q:
+    return Q(
+        **{
+            f"{prefix}_lat__range": (b.sw_lat, b.ne_lat),
+            f"{prefix}_lng__range": (b.sw_lon, b.ne_lon),
+        }
+    )
+
+
+def get_indexed_segments(tiles: list[Tile]) -> dict[str, tuple[list[dict], float]]:
+    """Answer tiles with fresh local coverage without calling Strava.
+
+    Returns a cache key -> (segments, explored_at timestamp) mapping for the
+    tiles that were explored within SEGMENT_INDEX_MAX_AGE, or
+    SEGMENT_EMPTY_TTL for tiles without segments; the rest still need an
+    upstream fetch. Segments are read with one query over the tiles' boxes,
+    using the indexes on their start and end points.
+    """
+    if not tiles:
+        return {}
+    cutoff = timezone.now() - timedelta(seconds=settings.SEGMENT_INDEX_MAX_AGE)
+    wanted = Q()
+    for zoom, x, y in tiles:
+        wanted |= Q(zoom=zoom, x=x, y=y)
+    explored = {
+        (row.zoom, row.x, row.y): row.explored_at.timestamp()
+        for row in ExploredTile.objects.filter(wanted, explored_at__gte=cutoff)
+    }
+    if not explored:
+        return {}
+
+    boxes = Q()
+    for tile in explored:
+        b = get_tile_bounds(tile)
+        boxes |= _in_bounds("start", b) | _in_bounds("end", b)
+    rows = Segment.objects.filter(boxes)
+    segments = to_search_segments([segment_to_explorer(r) for r in rows])
+
+    indexed: dict[str, tuple[list[dict], float]] = {}
+    for tile, explored_at in explored.items():
+        data = geo.touching_bounds(segments, get_tile_bounds(tile).to_list())
+        if time.time() - explored_at < _max_age(data):
+            indexed[generate_tile_cache_key(tile)] = (data, explored_at)
+    return indexed
+
+
+def save_segments(explore_segments: list[ExplorerSegment]) -> None:
+    """Upsert explored segments."""
+    if not explore_segments:
+        return
+    Segment.objects.bulk_create(
+        [
+            Segment(
+                strava_id=s.id,
+                name=s.name,
+                climb_category=s.climb_category,
+                climb_category_desc=s.climb_category_desc,
+                avg_grade=s.avg_grade,
+                distance=s.distance,
+                elev_difference=s.elev_difference,
+                start_lat=s.start_latlng[0],
+                start_lng=s.start_latlng[1],
+                end_lat=s.end_latlng[0],
+                end_lng=s.end_latlng[1],
+            )
+            for s in explore_segments
+        ],
+        update_conflicts=True,
+        unique_fields=["strava_id"],
+        update_fields=[
+            "name",
+            "climb_category",
+            "climb_category_desc",
+            "avg_grade",
+            "distance",
+            "elev_difference",
+            "start_lat",
+            "start_lng",
+            "end_lat",
+            "end_lng",
+            "updated_at",
+        ],
+    )
+
+
+def save_explored_tile(tile: Tile, explore_segments: list[ExplorerSegment]) -> None:
+    """Persist a tile's explore result and mark the tile as covered."""
+    save_segments(explore_segments)
+
+    zoom, x, y = tile
+    explored_at = timezone.now()
+    ExploredTile.objects.update_or_create(
+        zoom=zoom, x=x, y=y, defaults={"explored_at": explored_at}
+    )
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from django.conf import settings
+
+from activity import aiocache, metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def lock_key(key: str) -> str:
+    return f"singleflight:lock:{key}"
+
+
+def result_key(key: str) -> str:
+    return f"singleflight:result:{key}"
+
+
+async def _wait_for_results(keys: list[str]) -> dict[str, object]:
+    """Poll for the results of fetches other workers are running.
+
+    Stops early for keys whose lock went away without a result, which means
+    the leader failed and there is nothing left to wait for.
+    """
+    results: dict[str, object] = {}
+    pending = list(keys)
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT
+    while pending and time.monotonic() < deadline:
+        await asyncio.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        found = await aiocache.get_many(
+            [result_key(k) for k in pending] + [lock_key(k) for k in pending]
+        )
+        still_pending = []
+        for key in pending:
+            if result_key(key) in found:
+                results[key] = found[result_key(key)]
+            elif lock_key(key) in found:
+                still_pending.append(key)
+        pending = still_pending
+    return results
+
+
+async def coalesce(
+    keys: list[str], fetch: Callable[[list[str]], Awaitable[dict[str, T]]]
+) -> dict[str, T]:
+    """Run fetch for keys with at most one fetch in flight per key.
+
+    The lock lives in Redis so it holds across uvicorn workers. Keys another
+    worker is already fetching are waited on for up to SINGLE_FLIGHT_WAIT
+    seconds; if no result shows up in time we fetch them ourselves.
+    """
+    token = uuid.uuid4().hex
+    leading = [
+        k for k in keys if await aiocache.add(lock_key(k), token, settings.SINGLE_FLIGHT_LOCK_TTL)
+    ]
+    following = [k for k in keys if k not in leading]
+
+    results: dict[str, T] = {}
+    if leading:
+        try:
+            results.update(await fetch(leading))
+            await aiocache.set_many(
+                {result_key(k): v for k, v in results.items()},
+                timeout=settings.SINGLE_FLIGHT_RESULT_TTL,
+            )
+        finally:
+            # Only release locks that are still ours
+            owned = await aiocache.get_many([lock_key(k) for k in leading])
+            await aiocache.delete_many([lk for lk, v in owned.items() if v == token])
+        await metrics.aincr("singleflight.leader", len(leading))
+
+    if following:
+        waited = await _wait_for_results(following)
+        results.update(waited)  # type: ignore[arg-type]
+        fallback = [k for k in following if k not in waited]
+        await metrics.aincr("singleflight.coalesced", len(waited))
+        if fallback:
+            logger.warning(f"singleflight: wait expired for {len(fallback)} keys")
+            await metrics.aincr("singleflight.fallback", len(fallback))
+            results.update(await fetch(fallback))
+        logger.info(
+            f"singleflight: coalesced {len(waited)}/{len(following)} in-flight keys"
+        )
+    return results
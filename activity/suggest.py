@@ -0,0 +1,62 @@
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from activity.models import GeocodedLocation
+from activity.utils import normalize_query
+
+
+class PrefixIndex:
+    """Sorted array of location names answering prefix queries with bisect."""
+
+    def __init__(self):
+        self._names: list[str] = []
+        self._built_at: float | None = None
+        self._lock = threading.Lock()
+
+    def is_stale(self) -> bool:
+        # Rebuild now and then to pick up geocodes saved by other workers
+        return self._built_at is None or time.time() - self._built_at > settings.SUGGEST_INDEX_TTL
+
+    def build(self, names: list[str]) -> None:
+        names = sorted(set(names))
+        with self._lock:
+            self._names = names
+            self._built_at = time.time()
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            i = bisect.bisect_left(self._names, name)
+            if i == len(self._names) or self._names[i] != name:
+                self._names.insert(i, name)
+
+    def search(self, prefix: str, limit: int = 10) -> list[str]:
+        with self._lock:
+            names = self._names
+        start = bisect.bisect_left(names, prefix)
+        # Every name with this prefix sorts before prefix + the max code point
+        end = bisect.bisect_left(names, prefix + "\U0010ffff", lo=start)
+        return names[start : min(end, start + limit)]
+
+
+location_index = PrefixIndex()
+
+
+def suggest_locations(raw_query: str, limit: int = 10) -> list[str]:
+    prefix = normalize_query(raw_query)
+    if not prefix:
+        return []
+    if location_index.is_stale():
+        location_index.build(list(GeocodedLocation.objects.values_list("user_query", flat=True)))
+    return location_index.search(prefix, limit)
+
+
+@receiver(post_save, sender=GeocodedLocation)
+def index_geocoded_location(sender, instance, created, **kwargs):
+    # Keeps this worker's index current without waiting for a rebuild
+    if created:
+        location_index.add(instance.user_query)
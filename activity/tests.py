@@ -1,3 +1,248 @@
-from django.test import TestCase
+import asyncio
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from activity import codec, quota, utils
+from activity.codec import CodecError, decode_segments, encode_segments
+from activity.results import InvalidCursor, encode_cursor, filter_segments
+from activity.schemas import CoorsSchema, SearchPayloadSchema, SegmentBoundsSchema
+from activity.singleflight import coalesce, lock_key, result_key
+
+# Redis isn't needed: activity.aiocache falls back to Django's cache API
+LOCMEM = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def make_segment(segment_id: int, lat: float, lng: float, **fields) -> dict:
+    return {
+        "id": segment_id,
+        "name": f"Segment {segment_id}",
+        "difficulty": "Moderate",
+        "distance": 1.5,
+        "avg_grade": 6.0,
+        "start_latlng": [lat, lng],
+        "end_latlng": [lat + 0.01, lng + 0.01],
+        "elev_difference": 120.0,
+        **fields,
+    }
+
+
+@override_settings(CACHES=LOCMEM)
+class CacheTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        utils._segment_l1.clear()
+        utils._geocode_lru.clear()
+
+
+class TileTests(SimpleTestCase):
+    def test_tile_contains_its_point(self):
+        tile = (10, *utils.latlon_to_tile(37.3, -121.9, 10))
+        b = utils.get_tile_bounds(tile)
+        self.assertTrue(b.sw_lat <= 37.3 <= b.ne_lat)
+        self.assertTrue(b.sw_lon <= -121.9 <= b.ne_lon)
+
+    def test_small_box_keeps_the_zoom(self):
+        bounds = SegmentBoundsSchema(sw_lat=37.30, sw_lon=-121.95, ne_lat=37.32, ne_lon=-121.93)
+        tiles = utils.get_tiles(bounds, zoom=10, max_tiles=9)
+        self.assertEqual({zoom for zoom, _, _ in tiles}, {10})
+
+    def test_wide_box_steps_down_to_fit_max_tiles(self):
+        bounds = SegmentBoundsSchema(sw_lat=36.0, sw_lon=-123.0, ne_lat=38.5, ne_lon=-120.5)
+        tiles = utils.get_tiles(bounds, zoom=10, max_tiles=9)
+        self.assertLessEqual(len(tiles), 9)
+        self.assertLess(tiles[0][0], 10)
+        # The coarser tiles still cover the whole box
+        corners = [(bounds.sw_lat, bounds.sw_lon), (bounds.ne_lat, bounds.ne_lon)]
+        zoom = tiles[0][0]
+        for lat, lng in corners:
+            self.assertIn((zoom, *utils.latlon_to_tile(lat, lng, zoom)), tiles)
+
+    def test_ancestor_tiles(self):
+        self.assertEqual(utils.get_ancestor_tiles((10, 165, 397), 2), [(9, 82, 198), (8, 41, 99)])
+        self.assertEqual(utils.get_ancestor_tiles((1, 1, 0), 3), [(0, 0, 0)])
+
+
+class CodecTests(SimpleTestCase):
+    data = [
+        make_segment(1, 37.1, -121.1),
+        make_segment(2, 37.2, -121.2, name="Côte", difficulty="Hard"),
+    ]
+
+    def assertRoundTrip(self, compression: str):
+        raw = encode_segments(self.data, fresh_until=1234.5, compression=compression)
+        self.assertEqual(decode_segments(raw), (self.data, 1234.5))
+
+    def test_round_trip_uncompressed(self):
+        self.assertRoundTrip("none")
+
+    @skipUnless(codec.zstandard, "zstandard is not installed")
+    def test_round_trip_zstd(self):
+        self.assertRoundTrip("zstd")
+
+    @skipUnless(codec.lz4_frame, "lz4 is not installed")
+    def test_round_trip_lz4(self):
+        self.assertRoundTrip("lz4")
+
+    def test_empty_tile(self):
+        self.assertEqual(decode_segments(encode_segments([], 0.0)), ([], 0.0))
+
+    def test_truncated_entry(self):
+        raw = encode_segments(self.data, 0.0)
+        with self.assertRaises(CodecError):
+            decode_segments(raw[:-20])
+        with self.assertRaises(CodecError):
+            decode_segments(b"NCSG")
+
+
+class CursorTests(SimpleTestCase):
+    center = CoorsSchema(latitude=37.3, longitude=-121.9)
+    segments = [make_segment(i, 37.3 + i * 0.01, -121.9) for i in range(7)]
+
+    def query(self, **params) -> SearchPayloadSchema:
+        return SearchPayloadSchema(location="San Jose", radius=20, **params)
+
+    def test_pages_cover_every_segment_once(self):
+        seen, cursor = [], None
+        while True:
+            page = filter_segments(self.segments, self.center, self.query(limit=3, cursor=cursor))
+            self.assertEqual(page["total"], 7)
+            seen += [s["id"] for s in page["segments"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(range(7)))
+
+    def test_malformed_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            filter_segments(self.segments, self.center, self.query(cursor="not-a-cursor"))
+        short = encode_cursor("distance", [1.0])
+        with self.assertRaises(InvalidCursor):
+            filter_segments(self.segments, self.center, self.query(cursor=short))
+        for key in (["far", 3], [1.0, None], [True, 3]):
+            cursor = encode_cursor("distance", key)
+            with self.assertRaises(InvalidCursor):
+                filter_segments(self.segments, self.center, self.query(cursor=cursor))
+
+    def test_cursor_from_another_sort(self):
+        cursor = encode_cursor("difficulty", [1.0, 0.5, 2.0])
+        with self.assertRaises(InvalidCursor):
+            filter_segments(self.segments, self.center, self.query(cursor=cursor))
+
+
+@override_settings(STRAVA_SHORT_LIMIT=4, STRAVA_DAILY_LIMIT=1000, STRAVA_BACKGROUND_SHARE=0.5)
+class QuotaTests(CacheTestCase):
+    def test_reserves_up_to_the_limit(self):
+        self.assertEqual([quota.reserve(1) for _ in range(5)], [True] * 4 + [False])
+        # The refused call is rolled back, not counted
+        self.assertEqual(cache.get(quota.short_sent_key(1)), 4)
+        self.assertEqual(quota.get_remaining([1]), {1: 0})
+
+    def test_background_gets_its_share(self):
+        self.assertEqual([quota.reserve(1, "background") for _ in range(3)], [True, True, False])
+        # What background work left is still there for users
+        self.assertTrue(quota.reserve(1, "user"))
+
+    def test_window_strava_reports_full_is_refused(self):
+        cache.set(quota.short_quota_key(1), (4, 4))
+        self.assertFalse(quota.reserve(1))
+        self.assertFalse(quota.reserve(1, "background"))
+
+    async def test_async_reserve_shares_the_counters(self):
+        await cache.aset(quota.short_sent_key(1), 1)
+        results = [await quota.areserve(1) for _ in range(4)]
+        self.assertEqual(results, [True] * 3 + [False])
+
+
+@override_settings(SINGLE_FLIGHT_WAIT=0.3, SINGLE_FLIGHT_POLL_INTERVAL=0.05)
+class SingleFlightTests(CacheTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+
+    async def fetch(self, keys: list[str]) -> dict[str, str]:
+        self.calls.append(keys)
+        return {k: f"fetched {k}" for k in keys}
+
+    async def test_leader_fetches_and_releases_the_lock(self):
+        results = await coalesce(["a", "b"], self.fetch)
+        self.assertEqual(results, {"a": "fetched a", "b": "fetched b"})
+        self.assertEqual(self.calls, [["a", "b"]])
+        self.assertIsNone(await cache.aget(lock_key("a")))
+        self.assertEqual(await cache.aget(result_key("a")), "fetched a")
+
+    async def test_follower_waits_for_the_leader(self):
+        await cache.aset(lock_key("a"), "another worker")
+        await cache.aset(result_key("a"), "theirs")
+        self.assertEqual(await coalesce(["a", "b"], self.fetch), {"a": "theirs", "b": "fetched b"})
+        self.assertEqual(self.calls, [["b"]])
+
+    async def test_follower_falls_back_when_no_result_shows_up(self):
+        await cache.aset(lock_key("a"), "another worker")
+        self.assertEqual(await coalesce(["a"], self.fetch), {"a": "fetched a"})
+        self.assertEqual(self.calls, [["a"]])
+
+
+class TileCacheTests(CacheTestCase):
+    key = "strava:tile:10:165:397"
+    data = [make_segment(1, 37.3, -121.9)]
+
+    def read(self):
+        # Skip the L1 so each read goes through the Redis entry
+        utils._segment_l1.clear()
+        return utils.get_cached_segments([self.key])
+
+    def test_fresh_entry(self):
+        utils.set_cached_segments(self.key, self.data)
+        self.assertEqual(self.read(), ({self.key: self.data}, []))
+
+    @override_settings(SEGMENT_CACHE_SOFT_TTL=-1)
+    def test_past_soft_ttl_is_served_stale(self):
+        utils.set_cached_segments(self.key, self.data)
+        self.assertEqual(self.read(), ({self.key: self.data}, [self.key]))
+
+    def test_past_hard_ttl_is_a_miss(self):
+        utils.set_cached_segments(self.key, self.data)
+        cache.delete(self.key)
+        self.assertEqual(self.read(), ({}, []))
+
+    def test_soft_ttl_counts_from_when_the_tile_was_fetched(self):
+        explored_at = time.time() - 2 * 86400
+        fresh_until = asyncio.run(utils.aset_cached_segments(self.key, self.data, explored_at))
+        self.assertLess(fresh_until, time.time())
+        self.assertEqual(self.read(), ({self.key: self.data}, [self.key]))
+
+    @override_settings(SEGMENT_EMPTY_TTL=60, SEGMENT_CACHE_HARD_TTL=3600)
+    def test_empty_tile_is_a_short_negative_entry(self):
+        _, timeout, fresh_until = utils._cache_entry(self.key, [])
+        self.assertEqual(timeout, 60)
+        self.assertAlmostEqual(fresh_until, time.time() + 60, delta=5)
+        _, timeout, _ = utils._cache_entry(self.key, self.data)
+        self.assertEqual(timeout, 3600)
+
+
+@override_settings(CACHES=LOCMEM)
+class GeocodeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        utils._geocode_lru.clear()
+
+    def test_unknown_place_is_remembered(self):
+        geocode = mock.AsyncMock(return_value=None)
+        with mock.patch("activity.utils.ageocode", geocode):
+            self.assertIsNone(utils.get_coors("Atlantis"))
+            utils._geocode_lru.clear()
+            # Answered by the negative entry in the cache, not Nominatim
+            self.assertIsNone(utils.get_coors("atlantis"))
+        geocode.assert_awaited_once()
+        self.assertEqual(cache.get(utils.geocode_cache_key("atlantis")), utils.GEOCODE_NOT_FOUND)
+
+    def test_found_place_is_cached(self):
+        geocode = mock.AsyncMock(return_value=CoorsSchema(latitude=1.0, longitude=2.0))
+        with mock.patch("activity.utils.ageocode", geocode):
+            first = utils.get_coors("Somewhere")
+            second = utils.get_coors("somewhere")
+        self.assertEqual((first, second), (CoorsSchema(latitude=1.0, longitude=2.0),) * 2)
+        geocode.assert_awaited_once()
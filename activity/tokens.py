@@ -0,0 +1,206 @@
+import logging
+import random
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from redis.exceptions import LockError
+from stravalib import Client
+
+from activity import aiocache
+from activity.clients import get_session
+from activity.models import StravaAuth
+from activity.quota import (
+    Priority,
+    QuotaRecorder,
+    aget_remaining,
+    aget_retry_after,
+    areserve,
+    get_remaining,
+    get_retry_after,
+    reserve,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class StravaRateLimited(Exception):
+    """No pooled Strava account has quota left for another request."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Strava rate limit reached, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+# Process-local copies of the tokens: auth id -> {"access_token", "expires_at"}
+_tokens: dict[int, dict] = {}
+# Process-local copy of the active account ids and when it was loaded
+_pool: tuple[float, list[int]] = (0.0, [])
+
+
+def token_cache_key(auth_id: int) -> str:
+    return f"strava:token:{auth_id}"
+
+
+def _is_fresh(token: dict | None) -> bool:
+    # Refresh ahead of expiry so no request ever goes out with a dying token
+    return bool(token) and token["expires_at"] - settings.STRAVA_TOKEN_REFRESH_AHEAD > time.time()
+
+
+def _remember(auth_id: int, token: dict) -> None:
+    _tokens[auth_id] = token
+    ttl = int(token["expires_at"] - time.time())
+    if ttl > 0:
+        cache.set(token_cache_key(auth_id), token, timeout=ttl)
+
+
+def _load_or_refresh(auth_id: int) -> dict:
+    """Read the token from the DB, refreshing it with Strava if it is close
+    to expiry. Must be called while holding the refresh lock."""
+    strava_auth = StravaAuth.objects.get(id=auth_id)
+    client = Client(requests_session=get_session())
+    if strava_auth.check_and_refresh(client, buffer=settings.STRAVA_TOKEN_REFRESH_AHEAD):
+        logger.info(f"tokens: refreshed Strava access token for account {auth_id}")
+    return {"access_token": strava_auth.access_token, "expires_at": strava_auth.expires_at}
+
+
+def get_access_token(auth_id: int) -> str:
+    """Returns a valid Strava access token for a pooled account.
+
+    Looks in process memory, then Redis, and only reaches the DB when both
+    are empty or about to expire. Refreshes happen under a Redis lock so
+    concurrent workers can't race each other and overwrite a newer
+    refresh_token with a stale one.
+    """
+    if _is_fresh(_tokens.get(auth_id)):
+        return _tokens[auth_id]["access_token"]
+
+    token = cache.get(token_cache_key(auth_id))
+    if _is_fresh(token):
+        _remember(auth_id, token)
+        return token["access_token"]
+
+    try:
+        with cache.lock(
+            f"strava:token:lock:{auth_id}",
+            timeout=30,
+            blocking_timeout=settings.STRAVA_TOKEN_LOCK_WAIT,
+        ):
+            # Another worker may have refreshed while we waited for the lock
+            token = cache.get(token_cache_key(auth_id))
+            if not _is_fresh(token):
+                token = _load_or_refresh(auth_id)
+    except LockError:
+        logger.warning(f"tokens: timed out waiting for the refresh lock of {auth_id}")
+        token = cache.get(token_cache_key(auth_id)) or _tokens.get(auth_id)
+        if not token or token["expires_at"] <= time.time():
+            raise
+
+    _remember(auth_id, token)
+    return token["access_token"]
+
+
+async def aget_access_token(auth_id: int) -> str:
+    if _is_fresh(_tokens.get(auth_id)):
+        return _tokens[auth_id]["access_token"]
+
+    token = await aiocache.get(token_cache_key(auth_id))
+    if _is_fresh(token):
+        _tokens[auth_id] = token
+        return token["access_token"]
+
+    # Refreshing takes the Redis lock and the DB, which only happens about
+    # once per token lifetime
+    return await sync_to_async(get_access_token)(auth_id)
+
+
+def get_pool() -> list[int]:
+    """Ids of the active StravaAuth accounts, reloaded every STRAVA_POOL_TTL."""
+    global _pool
+    loaded_at, auth_ids = _pool
+    if time.time() - loaded_at > settings.STRAVA_POOL_TTL:
+        auth_ids = list(
+            StravaAuth.objects.filter(is_active=True).order_by("id").values_list("id", flat=True)
+        )
+        _pool = (time.time(), auth_ids)
+    return auth_ids
+
+
+async def aget_pool() -> list[int]:
+    global _pool
+    loaded_at, auth_ids = _pool
+    if time.time() - loaded_at > settings.STRAVA_POOL_TTL:
+        rows = (
+            StravaAuth.objects.filter(is_active=True).order_by("id").values_list("id", flat=True)
+        )
+        auth_ids = [auth_id async for auth_id in rows]
+        _pool = (time.time(), auth_ids)
+    return auth_ids
+
+
+def pick_account(priority: Priority = "user") -> int:
+    """Reserve one request on the pooled account with the most quota left.
+
+    Ties go to a random account so concurrent workers spread their calls.
+    Raises StravaRateLimited right away when no account has budget left for
+    this priority, rather than sending a call Strava would reject.
+    """
+    auth_ids = get_pool()
+    if not auth_ids:
+        raise StravaAuth.DoesNotExist("No active StravaAuth account is configured")
+    remaining = get_remaining(auth_ids, priority)
+    candidates = [a for a in auth_ids if remaining[a] > 0]
+    random.shuffle(candidates)
+    for auth_id in sorted(candidates, key=lambda a: remaining[a], reverse=True):
+        if reserve(auth_id, priority):
+            return auth_id
+    raise StravaRateLimited(get_retry_after(auth_ids, priority))
+
+
+async def apick_account(priority: Priority = "user") -> int:
+    auth_ids = await aget_pool()
+    if not auth_ids:
+        raise StravaAuth.DoesNotExist("No active StravaAuth account is configured")
+    remaining = await aget_remaining(auth_ids, priority)
+    candidates = [a for a in auth_ids if remaining[a] > 0]
+    random.shuffle(candidates)
+    for auth_id in sorted(candidates, key=lambda a: remaining[a], reverse=True):
+        if await areserve(auth_id, priority):
+            return auth_id
+    raise StravaRateLimited(await aget_retry_after(auth_ids, priority))
+
+
+def reserve_access_token(priority: Priority = "user") -> tuple[int, str]:
+    """Reserve one upstream call and return the account id and its token."""
+    auth_id = pick_account(priority)
+    return auth_id, get_access_token(auth_id)
+
+
+async def aensure_quota(priority: Priority = "user") -> None:
+    """Raise StravaRateLimited if no pooled account has quota left for this
+    priority, without reserving anything."""
+    auth_ids = await aget_pool()
+    remaining = await aget_remaining(auth_ids, priority)
+    if auth_ids and not any(left > 0 for left in remaining.values()):
+        raise StravaRateLimited(await aget_retry_after(auth_ids, priority))
+
+
+async def areserve_access_token(priority: Priority = "user") -> tuple[int, str]:
+    auth_id = await apick_account(priority)
+    return auth_id, await aget_access_token(auth_id)
+
+
+def get_client(priority: Priority = "user") -> Client:
+    """A Strava client for exactly one upstream call.
+
+    Building the client reserves that call's slot in the shared budget. The
+    client records the account's usage from the response, replacing
+    stravalib's default limiter which sleeps in-request when limits are hit.
+    """
+    auth_id, access_token = reserve_access_token(priority)
+    return Client(
+        access_token=access_token,
+        rate_limiter=QuotaRecorder(auth_id),
+        requests_session=get_session(),
+    )
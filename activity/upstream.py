@@ -0,0 +1,50 @@
+"""Non-blocking calls to Strava and Nominatim for the async request path.
+
+The sync stravalib client is still used by background work; these
+mirror the two calls search makes on its critical path.
+"""
+
+from activity.clients import get_async_client, trace
+from activity.quota import QuotaRecorder
+from activity.schemas import CoorsSchema
+
+STRAVA_API_URL = "https://www.strava.com/api/v3"
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+
+
+async def aexplore_segments(
+    access_token: str,
+    bounds: tuple[float, float, float, float],
+    quota: QuotaRecorder,
+) -> list[dict]:
+    """Strava's segment explorer, returning the raw segment dicts."""
+    response = await get_async_client().get(
+        f"{STRAVA_API_URL}/segments/explore",
+        params={
+            "bounds": ",".join(str(b) for b in bounds),
+            "activity_type": "riding",
+            "min_cat": 1,
+            "max_cat": 4,
+        },
+        headers={"Authorization": f"Bearer {access_token}"},
+        extensions={"trace": trace},
+    )
+    await quota.arecord(response.headers, "GET")
+    response.raise_for_status()
+    return response.json()["segments"]
+
+
+async def ageocode(query: str) -> CoorsSchema | None:
+    """Nominatim lookup: the first match for query, or None."""
+    response = await get_async_client().get(
+        NOMINATIM_URL,
+        params={"q": query, "format": "json", "limit": 1},
+        # 'User-Agent' is required by the Nominatim usage policy
+        headers={"User-Agent": "nextclimb.fit"},
+        extensions={"trace": trace},
+    )
+    response.raise_for_status()
+    results = response.json()
+    if not results:
+        return None
+    return CoorsSchema(latitude=float(results[0]["lat"]), longitude=float(results[0]["lon"]))
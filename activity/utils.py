@@ -1,115 +1,483 @@
+import hashlib
 import logging
 import math
 import re
+import time
+from collections.abc import Iterable
 
+import httpx
+import orjson
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.core.cache import cache
-from geopy.distance import geodesic
-from geopy.exc import GeocoderServiceError, GeocoderTimedOut
-from geopy.geocoders import Nominatim
 from typing_extensions import Sequence
 
+from activity import aiocache, aliases, backoff, geo, l1
+from activity.codec import (
+    CodecError,
+    available_compression,
+    decode_segments,
+    encode_segments,
+)
+from activity.difficulty import classify
+from activity.gazetteer import lookup_place
+from activity.lru import MISSING, LRUCache
 from activity.models import GeocodedLocation
-from activity.schemas import CoorsSchema, SearchResponseSchema, SegmentBoundsSchema
+from activity.schemas import (
+    CoorsSchema,
+    ExplorerSegment,
+    SearchPayloadSchema,
+    SegmentBoundsSchema,
+)
+from activity.upstream import ageocode
 
 logger = logging.getLogger(__name__)
 
 
-def get_coors(raw_query: str) -> CoorsSchema | None:
-    # 1. Initialize the geocoding service
-    # 'user_agent' is required; use your app's name
-    geolocator = Nominatim(user_agent="nextclimb.fit", timeout=10)
+# Marks a query Nominatim could not resolve, so we don't keep asking
+GEOCODE_NOT_FOUND = "not-found"
+
+_geocode_lru = LRUCache(maxsize=settings.GEOCODE_LRU_SIZE)
+_segment_l1 = LRUCache(maxsize=settings.SEGMENT_L1_SIZE)
+# Writes by other processes drop our copies, see activity.l1
+l1.register("geocode:", _geocode_lru, lambda key: key.removeprefix("geocode:"))
+l1.register("strava:tile:", _segment_l1)
+
+
+def geocode_cache_key(normalized_query: str) -> str:
+    return f"geocode:{normalized_query}"
+
+
+def _remember_coors(
+    normalized_query: str, coors: CoorsSchema | None
+) -> tuple[object, int]:
+    """Fill the in-process tier for a resolved (or unresolvable) query and
+    return the Redis entry and timeout for the caller to write."""
+    if coors is None:
+        _geocode_lru.set(normalized_query, None, timeout=settings.GEOCODE_NEGATIVE_TTL)
+        return GEOCODE_NOT_FOUND, settings.GEOCODE_NEGATIVE_TTL
+    _geocode_lru.set(normalized_query, coors)
+    return (
+        {"latitude": coors.latitude, "longitude": coors.longitude},
+        settings.GEOCODE_CACHE_TTL,
+    )
+
+
+async def _acache_coors(normalized_query: str, coors: CoorsSchema | None) -> None:
+    key = geocode_cache_key(normalized_query)
+    await aiocache.set(key, *_remember_coors(normalized_query, coors))
+    await l1.apublish([key])
+
+
+def _get_local_coors(normalized_query: str) -> CoorsSchema | None | object:
+    """The tiers that need no I/O. Returns MISSING when neither knows the query."""
+    # 1. In-process LRU
+    l1.ensure_listener()
+    coors = _geocode_lru.get(normalized_query)
+    if coors is not MISSING:
+        l1.record("cache.geocode.l1.hit")
+        if coors is None:
+            l1.record("cache.geocode.negative.hit")
+        return coors
+    l1.record("cache.geocode.l1.miss")
+
+    # 1b. Offline gazetteer, a memory-mapped lookup of known place names
+    coors = lookup_place(normalized_query)
+    if coors:
+        _geocode_lru.set(normalized_query, coors)
+        return coors
+    return MISSING
+
+
+def _from_cache_entry(normalized_query: str, cached: object) -> CoorsSchema | None | object:
+    if cached == GEOCODE_NOT_FOUND:
+        l1.record("cache.geocode.redis.hit")
+        l1.record("cache.geocode.negative.hit")
+        _geocode_lru.set(normalized_query, None, timeout=settings.GEOCODE_NEGATIVE_TTL)
+        return None
+    if cached:
+        l1.record("cache.geocode.redis.hit")
+        coors = CoorsSchema(**cached)
+        _geocode_lru.set(normalized_query, coors)
+        return coors
+    l1.record("cache.geocode.redis.miss")
+    return MISSING
+
+
+async def aget_coors(raw_query: str) -> CoorsSchema | None:
+    """Geocode a free-text location.
+
+    Tiers are checked in order: in-process LRU, the offline gazetteer (when
+    one is installed), Redis, the GeocodedLocation table and finally
+    Nominatim. A hit fills every tier above it, and queries Nominatim can't
+    resolve are remembered for GEOCODE_NEGATIVE_TTL. Queries Nominatim
+    failed on are retried only after a backoff, see activity.backoff.
+    Known aliases are looked up under their canonical spelling.
+    """
+    normalized_query = await aliases.aresolve(normalize_query(raw_query))
+    key = geocode_cache_key(normalized_query)
+
+    coors = _get_local_coors(normalized_query)
+    if coors is not MISSING:
+        return coors
+
+    coors = _from_cache_entry(normalized_query, await aiocache.get(key))
+    if coors is not MISSING:
+        return coors
 
     try:
-        normalized_query = normalize_query(raw_query)
-        existing = GeocodedLocation.objects.filter(user_query=normalized_query).first()
+        existing = await GeocodedLocation.objects.filter(user_query=normalized_query).afirst()
         if existing:
             logger.info("returning coordinates from local database.")
-            return CoorsSchema(latitude=existing.latitude, longitude=existing.longitude)
-        # 2. Perform the lookup
-        location = geolocator.geocode(raw_query)
-
-        if location:
-            logger.info(f"get_coors: {location.latitude}, {location.longitude}")
-            # 5. Save to DB
-            GeocodedLocation.objects.create(
+            coors = CoorsSchema(latitude=existing.latitude, longitude=existing.longitude)
+            await _acache_coors(normalized_query, coors)
+            return coors
+
+        if await backoff.ablocked([key]):
+            l1.record("backoff.geocode.blocked")
+            return None
+        coors = await ageocode(raw_query)
+
+        if coors:
+            logger.info(f"get_coors: {coors.latitude}, {coors.longitude}")
+            await GeocodedLocation.objects.acreate(
                 user_query=normalized_query,
-                latitude=location.latitude,
-                longitude=location.longitude,
+                latitude=coors.latitude,
+                longitude=coors.longitude,
             )
-            # Returns a tuple: (latitude, longitude)
-            return CoorsSchema(latitude=location.latitude, longitude=location.longitude)
+            await aliases.arecord(normalized_query, coors.latitude, coors.longitude)
+            await _acache_coors(normalized_query, coors)
+            return coors
 
         logger.info("location is None")
-        return None  # Return None if city not found
+        await _acache_coors(normalized_query, None)
+        return None
 
-    except (GeocoderTimedOut, GeocoderServiceError) as e:
+    except httpx.HTTPError as e:
         logger.exception(f"Error: {e}")
+        if backoff.is_transient(e):
+            delay = await backoff.arecord_failure(key, "geocode")
+            _geocode_lru.set(normalized_query, None, timeout=delay)
         return None
 
 
+def get_coors(raw_query: str) -> CoorsSchema | None:
+    """aget_coors for sync callers."""
+    return async_to_sync(aget_coors)(raw_query)
+
+
 def get_bounds(coors: CoorsSchema, radius: float) -> SegmentBoundsSchema:
-    center = (coors.latitude, coors.longitude)
+    # A square box with edges `radius` miles from the center, so the search
+    # circle fits inside it. Formatted as Strava wants: sw_lat,sw_lng,ne_lat,ne_lng
+    sw_lat, sw_lon, ne_lat, ne_lon = geo.bounding_box(coors.latitude, coors.longitude, radius)
+    return SegmentBoundsSchema(sw_lat=sw_lat, sw_lon=sw_lon, ne_lat=ne_lat, ne_lon=ne_lon)
 
-    # Note: For a "square" box with a 'radius', you actually go further
-    # out to the corner than just the radius. We use radius * sqrt(2)
-    # if you want the circle to be inside the box.
-    corner_dist = geodesic(miles=radius * math.sqrt(2))
 
-    # 1. Calculate Northeast corner (45 degrees)
-    ne_point = corner_dist.destination(center, bearing=45)
+def canonical_area(coors: CoorsSchema, radius: float) -> tuple[CoorsSchema, float]:
+    """The area a search is fetched for: the center snapped to the
+    SEARCH_CENTER_GRID and the radius rounded up to a SEARCH_RADIUS_BUCKETS
+    size, so nearby centers and similar radii land on the same tiles.
 
-    # 2. Calculate Southwest corner (225 degrees)
-    sw_point = corner_dist.destination(center, bearing=225)
-    print(
-        f"bounds--> {sw_point.latitude}, {sw_point.longitude}, {ne_point.latitude}, {ne_point.longitude}"
+    The area always contains the requested circle; results are filtered
+    back to the exact radius afterwards.
+    """
+    grid = settings.SEARCH_CENTER_GRID
+    center = CoorsSchema(
+        latitude=round(round(coors.latitude / grid) * grid, 6),
+        longitude=round(round(coors.longitude / grid) * grid, 6),
     )
-    # 3. Format exactly as Strava wants: "sw_lat,sw_lng,ne_lat,ne_lng"
-    return SegmentBoundsSchema(
-        sw_lat=sw_point.latitude,
-        sw_lon=sw_point.longitude,
-        ne_lat=ne_point.latitude,
-        ne_lon=ne_point.longitude,
+    bucket = next((b for b in settings.SEARCH_RADIUS_BUCKETS if b >= radius), radius)
+    # Snapping moves the center by up to half a cell diagonally, so grow the
+    # radius by that much; it depends only on the cell, keeping the area stable
+    margin = float(
+        geo.haversine_miles(
+            center.latitude, center.longitude, center.latitude + grid / 2, center.longitude + grid / 2
+        )
+    )
+    return center, bucket + margin
+
+
+def to_search_segments(explore_segments: Sequence[ExplorerSegment]) -> list[dict]:
+    """Search payload dicts, in the SearchResponseSchema shape, built
+    directly so they can be cached and encoded without another Pydantic pass."""
+    # Score the whole batch at once rather than one segment at a time
+    difficulties = classify(
+        [s.distance for s in explore_segments],
+        [s.elev_difference for s in explore_segments],
+        [s.avg_grade for s in explore_segments],
     )
+    return [
+        {
+            "id": item.id,
+            "name": item.name,
+            "difficulty": difficulty,
+            "distance": item.to_miles(),
+            "avg_grade": item.avg_grade,
+            "start_latlng": list(item.start_latlng),
+            "end_latlng": list(item.end_latlng),
+            "elev_difference": item.elev_difference,
+        }
+        for item, difficulty in zip(explore_segments, difficulties)
+    ]
+
 
+# (zoom, x, y) slippy-map tile address
+Tile = tuple[int, int, int]
 
-def get_normalized_bounds(
-    sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, precision: int = 2
-) -> tuple[float, float, float, float]:
-    factor = 10**precision
+# Strava's explorer returns at most this many segments for any box
+EXPLORE_SEGMENT_LIMIT = 10
 
-    # SW: Move Down and Left (Floor)
-    n_sw_lat = math.floor(sw_lat * factor) / factor
-    n_sw_lon = math.floor(sw_lon * factor) / factor
 
-    # NE: Move Up and Right (Ceiling)
-    n_ne_lat = math.ceil(ne_lat * factor) / factor
-    n_ne_lon = math.ceil(ne_lon * factor) / factor
+def latlon_to_tile(lat: float, lon: float, zoom: int) -> tuple[int, int]:
+    n = 2**zoom
+    lat = max(min(lat, 85.0511), -85.0511)  # Web Mercator stops at ~85 deg
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
 
-    return n_sw_lat, n_sw_lon, n_ne_lat, n_ne_lon
 
+def get_tile_bounds(tile: Tile) -> SegmentBoundsSchema:
+    zoom, x, y = tile
+    n = 2**zoom
 
-def generate_cache_key(
-    sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float
-) -> str:
-    n_sw_lat, n_sw_lon, n_ne_lat, n_ne_lon = get_normalized_bounds(
-        sw_lat, sw_lon, ne_lat, ne_lon
+    def tile_lat(ty: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return SegmentBoundsSchema(
+        sw_lat=tile_lat(y + 1),
+        sw_lon=x / n * 360.0 - 180.0,
+        ne_lat=tile_lat(y),
+        ne_lon=(x + 1) / n * 360.0 - 180.0,
     )
-    return f"strava:{n_sw_lat}:{n_sw_lon}:{n_ne_lat}:{n_ne_lon}"
+
+
+def get_tiles(
+    bounds: SegmentBoundsSchema,
+    zoom: int | None = None,
+    max_tiles: int | None = None,
+) -> list[Tile]:
+    zoom = settings.SEGMENT_TILE_ZOOM if zoom is None else zoom
+    max_tiles = settings.SEGMENT_TILE_MAX_COUNT if max_tiles is None else max_tiles
+
+    # Step down to coarser zoom levels until the box fits in max_tiles,
+    # so a 100 mile search doesn't turn into hundreds of Strava calls.
+    while True:
+        # Tile y grows southward, so the NE corner has the smallest y
+        min_x, min_y = latlon_to_tile(bounds.ne_lat, bounds.sw_lon, zoom)
+        max_x, max_y = latlon_to_tile(bounds.sw_lat, bounds.ne_lon, zoom)
+        count = (max_x - min_x + 1) * (max_y - min_y + 1)
+        if count <= max_tiles or zoom == 0:
+            break
+        zoom -= 1
+
+    return [
+        (zoom, x, y)
+        for x in range(min_x, max_x + 1)
+        for y in range(min_y, max_y + 1)
+    ]
+
+
+def get_ancestor_tiles(tile: Tile, levels: int) -> list[Tile]:
+    """The tiles containing tile up to `levels` zooms coarser, nearest first."""
+    zoom, x, y = tile
+    return [(zoom - k, x >> k, y >> k) for k in range(1, min(levels, zoom) + 1)]
+
+
+def generate_tile_cache_key(tile: Tile) -> str:
+    zoom, x, y = tile
+    return f"strava:tile:{zoom}:{x}:{y}"
+
+
+def _l1_segments(keys: Sequence[str]) -> tuple[dict[str, tuple[list[dict], float]], list[str]]:
+    """Entries held in process memory, and the keys that must go to Redis."""
+    l1.ensure_listener()
+    found = {}
+    for key in keys:
+        entry = _segment_l1.get(key)
+        if entry is not MISSING:
+            found[key] = entry
+    l1.record("cache.segments.l1.hit", len(found))
+    l1.record("cache.segments.l1.miss", len(keys) - len(found))
+    return found, [k for k in keys if k not in found]
+
+
+def _from_redis(
+    keys: list[str], raw: dict[str, bytes | dict]
+) -> dict[str, tuple[list[dict], float]]:
+    entries = {}
+    for key, entry in raw.items():
+        if isinstance(entry, dict):
+            # Written before the binary codec; read until it expires
+            entries[key] = (entry["data"], entry["fresh_until"])
+        else:
+            try:
+                entries[key] = decode_segments(entry)
+            except CodecError:
+                logger.warning(f"cache: unreadable entry for {key}, refetching")
+                continue
+        _segment_l1.set(key, entries[key], timeout=settings.SEGMENT_L1_TTL)
+    l1.record("cache.segments.redis.hit", len(entries))
+    l1.record("cache.segments.redis.miss", len(keys) - len(entries))
+    return entries
+
+
+def _split_stale(
+    entries: dict[str, tuple[list[dict], float]],
+) -> tuple[dict[str, list[dict[str, object]]], list[str]]:
+    now = time.time()
+    segments = {key: data for key, (data, _) in entries.items()}
+    l1.record("cache.segments.negative.hit", sum(1 for data in segments.values() if not data))
+    stale = [key for key, (_, fresh_until) in entries.items() if fresh_until < now]
+    return segments, stale
 
 
 def get_cached_segments(
-    sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float
-) -> tuple[list[SearchResponseSchema], str]:
-    # 1. Create the rounded key (2 decimal places ~1.1km precision)
-    key = generate_cache_key(sw_lat, sw_lon, ne_lat, ne_lon)
+    keys: Sequence[str],
+) -> tuple[dict[str, list[dict[str, object]]], list[str]]:
+    """Returns the cached segments by key and the keys past their soft TTL.
+
+    Stale entries are still returned so the caller can serve them right away
+    and refresh in the background. Keys missing from the cache (past the hard
+    TTL) are left out of both. Hot keys are answered from the in-process L1.
+    """
+    entries, missing = _l1_segments(keys)
+    if missing:
+        entries.update(_from_redis(missing, cache.get_many(missing)))
+    return _split_stale(entries)
+
+
+async def aget_cached_segments(
+    keys: Sequence[str],
+) -> tuple[dict[str, list[dict[str, object]]], list[str]]:
+    entries, missing = _l1_segments(keys)
+    if missing:
+        entries.update(_from_redis(missing, await aiocache.get_many(missing)))
+    return _split_stale(entries)
+
+
+def get_fresh_until(keys: Sequence[str]) -> dict[str, float]:
+    """Soft expiry of each key cached in Redis; missing keys are left out."""
+    keys = list(keys)
+    if not keys:
+        return {}
+    entries = _from_redis(keys, cache.get_many(keys))
+    return {key: fresh_until for key, (_, fresh_until) in entries.items()}
+
+
+async def aget_covering_segments(
+    tiles: Sequence[Tile],
+) -> tuple[dict[str, list[dict[str, object]]], list[Tile]]:
+    """Answer uncached tiles from a cached tile that contains them.
+
+    The tile pyramid is a quadtree, so the boxes that can contain a tile are
+    exactly its ancestors and finding them is arithmetic. Wide searches
+    cache coarse tiles, which then cover narrower searches inside them.
 
-    # 2. Return data if it exists, otherwise return None
-    return cache.get(key), key
+    An ancestor only counts if Strava returned fewer than
+    EXPLORE_SEGMENT_LIMIT segments for it: a full one was cut off, and the
+    segments of the smaller tile may be among those left out. Ancestors more
+    than SEGMENT_CONTAINMENT_MAX_LEVELS zooms up aren't used at all.
+    Returns the segments by the requested tiles' keys, and the ancestors
+    used that are past their soft TTL.
+    """
+    ancestors = {
+        tile: get_ancestor_tiles(tile, settings.SEGMENT_CONTAINMENT_MAX_LEVELS) for tile in tiles
+    }
+    ancestor_keys = {
+        generate_tile_cache_key(a): a for chain in ancestors.values() for a in chain
+    }
+    if not ancestor_keys:
+        return {}, []
+    cached, stale = await aget_cached_segments(list(ancestor_keys))
+
+    covered: dict[str, list[dict[str, object]]] = {}
+    used: set[str] = set()
+    for tile, chain in ancestors.items():
+        for ancestor in chain:
+            key = generate_tile_cache_key(ancestor)
+            if key in cached and len(cached[key]) < EXPLORE_SEGMENT_LIMIT:
+                covered[generate_tile_cache_key(tile)] = geo.touching_bounds(
+                    cached[key], get_tile_bounds(tile).to_list()
+                )
+                used.add(key)
+                break
+    return covered, [ancestor_keys[k] for k in stale if k in used]
+
+
+def _cache_entry(
+    key: str, data: Sequence[dict[str, object]], fetched_at: float | None = None
+) -> tuple[bytes, int, float]:
+    """Encode a tile for Redis and put it in this process's L1. Its soft TTL
+    counts from fetched_at, by default now. Returns the entry, its Redis
+    timeout and its soft expiry."""
+    data = list(data)
+    if data:
+        soft_ttl, hard_ttl = settings.SEGMENT_CACHE_SOFT_TTL, settings.SEGMENT_CACHE_HARD_TTL
+    else:
+        # An empty tile is a negative entry: it expires outright, sooner
+        soft_ttl = hard_ttl = settings.SEGMENT_EMPTY_TTL
+    fresh_until = (time.time() if fetched_at is None else fetched_at) + soft_ttl
+    _segment_l1.set(key, (data, fresh_until), timeout=min(settings.SEGMENT_L1_TTL, hard_ttl))
+    entry = encode_segments(
+        data,
+        fresh_until=fresh_until,
+        compression=available_compression(settings.SEGMENT_CACHE_COMPRESSION),
+    )
+    return entry, hard_ttl, fresh_until
 
 
 def set_cached_segments(key: str, data: Sequence[dict[str, object]]) -> None:
-    # Cache for 24 hours (86400 seconds)
-    cache.set(key, data, timeout=86400)
+    entry, timeout, _ = _cache_entry(key, data)
+    cache.set(key, entry, timeout=timeout)
+    l1.publish([key])
+
+
+async def aset_cached_segments(
+    key: str, data: Sequence[dict[str, object]], fetched_at: float | None = None
+) -> float:
+    """Cache a tile, returning when it goes stale."""
+    entry, timeout, fresh_until = _cache_entry(key, data, fetched_at)
+    await aiocache.set(key, entry, timeout)
+    await l1.apublish([key])
+    return fresh_until
+
+
+def search_response_key(query: SearchPayloadSchema, location: str) -> str:
+    """Key for a search's encoded response; location is the query's
+    normalized, alias-resolved spelling."""
+    params = query.model_dump()
+    params["location"] = location
+    params["difficulty"] = sorted(query.difficulty or [])
+    digest = hashlib.sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return f"search:response:{digest}"
+
+
+async def aget_cached_response(key: str) -> bytes | None:
+    return await aiocache.get(key)
+
+
+async def aset_cached_response(key: str, body: bytes) -> None:
+    await aiocache.set(key, body, settings.SEARCH_RESPONSE_TTL)
+
+
+def claim_refresh(key: str) -> bool:
+    """Only one worker gets to refresh a stale key per SEGMENT_REFRESH_LOCK_TTL."""
+    return cache.add(f"refresh:{key}", 1, timeout=settings.SEGMENT_REFRESH_LOCK_TTL)
+
+
+async def aclaim_refresh(key: str) -> bool:
+    return await aiocache.add(f"refresh:{key}", 1, settings.SEGMENT_REFRESH_LOCK_TTL)
+
+
+def merge_tile_segments(
+    tile_segments: Iterable[Sequence[dict]], bounds: SegmentBoundsSchema
+) -> list[dict]:
+    """Dedupe segments across tiles and drop the ones outside the search box."""
+    merged: dict[int, dict] = {}
+    for segments in tile_segments:
+        for segment in segments:
+            merged.setdefault(segment["id"], segment)
+    return geo.touching_bounds(list(merged.values()), bounds.to_list())
 
 
 def normalize_query(query: str) -> str:
@@ -0,0 +1,130 @@
+"""Pre-fill the tile cache for the areas people search most.
+
+Demand comes from what we already store: SearchFeedback rows carry the
+location and radius of a search, and GeocodedLocation rows record that a
+place was searched at all (radius unknown, so the default is assumed).
+Tiles under the top areas are fetched before they expire, most demanded
+first, until the Strava budget for the run is spent.
+"""
+
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from activity.api import fetch_tile_segments
+from activity.models import GeocodedLocation, SearchFeedback
+from activity.schemas import CoorsSchema
+from activity.tokens import StravaRateLimited
+from activity.utils import (
+    Tile,
+    canonical_area,
+    claim_refresh,
+    generate_tile_cache_key,
+    get_bounds,
+    get_fresh_until,
+    get_tiles,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def rank_demand(days: int, default_radius: int) -> list[tuple[str, int, int]]:
+    """(location, radius, searches) for the last `days`, most searched first."""
+    since = timezone.now() - timedelta(days=days)
+    demand: Counter[tuple[str, int]] = Counter()
+    feedback = (
+        SearchFeedback.objects.filter(created_at__gte=since)
+        .values_list("location", "radius")
+        .annotate(n=Count("id"))
+    )
+    for location, radius, n in feedback:
+        demand[(location, radius)] += n
+    # A geocode means the place was searched, but not at what radius
+    for location in GeocodedLocation.objects.filter(created_at__gte=since).values_list(
+        "user_query", flat=True
+    ):
+        demand[(location, default_radius)] += 1
+    return [(location, radius, n) for (location, radius), n in demand.most_common()]
+
+
+def plan_tiles(ranked: list[tuple[str, int, int]]) -> tuple[list[Tile], int]:
+    """Tiles under the ranked areas in demand order, and how many areas
+    couldn't be placed because they were never geocoded."""
+    locations = {location for location, _, _ in ranked}
+    coors = {
+        q: CoorsSchema(latitude=lat, longitude=lon)
+        for q, lat, lon in GeocodedLocation.objects.filter(user_query__in=locations).values_list(
+            "user_query", "latitude", "longitude"
+        )
+    }
+    tiles: dict[Tile, None] = {}
+    unresolved = 0
+    for location, radius, _ in ranked:
+        if location not in coors:
+            unresolved += 1
+            continue
+        # The same tiles a search for this area loads
+        for tile in get_tiles(get_bounds(*canonical_area(coors[location], radius))):
+            tiles.setdefault(tile)
+    return list(tiles), unresolved
+
+
+def warm_cache(
+    budget: int | None = None,
+    days: int | None = None,
+    ahead: int | None = None,
+) -> dict:
+    """Fetch the most demanded tiles that are missing or expire within
+    `ahead` seconds, spending at most `budget` Strava calls."""
+    budget = settings.WARM_CACHE_BUDGET if budget is None else budget
+    days = settings.WARM_CACHE_DAYS if days is None else days
+    ahead = settings.WARM_CACHE_AHEAD if ahead is None else ahead
+
+    ranked = rank_demand(days, settings.WARM_CACHE_DEFAULT_RADIUS)
+    tiles, unresolved = plan_tiles(ranked)
+    fresh_until = get_fresh_until([generate_tile_cache_key(t) for t in tiles])
+    deadline = time.time() + ahead
+    due = [t for t in tiles if fresh_until.get(generate_tile_cache_key(t), 0) < deadline]
+
+    warmed = failed = 0
+    rate_limited = False
+    chunk_size = settings.SEGMENT_TILE_FETCH_WORKERS
+    queue = due[:budget]
+    for i in range(0, len(queue), chunk_size):
+        # Skip tiles a search is already refreshing in the background
+        chunk = [t for t in queue[i : i + chunk_size] if claim_refresh(generate_tile_cache_key(t))]
+        if not chunk:
+            continue
+        fetched, errors = fetch_tile_segments(chunk, "background")
+        warmed += len(fetched)
+        # Upstream errors spent a call; tiles without quota didn't
+        failed += sum(1 for e in errors.values() if not isinstance(e, StravaRateLimited))
+        if any(isinstance(e, StravaRateLimited) for e in errors.values()):
+            logger.warning("warm: background budget exhausted")
+            rate_limited = True
+            break
+
+    report = {
+        "areas": len(ranked),
+        "unresolved": unresolved,
+        "tiles": len(tiles),
+        "due": len(due),
+        "warmed": warmed,
+        "failed": failed,
+        # One explore call per tile, whether it succeeded or not
+        "calls": warmed + failed,
+        "rate_limited": rate_limited,
+        "coverage_before": _coverage(len(tiles), len(tiles) - len(due)),
+        "coverage_after": _coverage(len(tiles), len(tiles) - len(due) + warmed),
+    }
+    logger.info(f"warm: {report}")
+    return report
+
+
+def _coverage(total: int, warm: int) -> float:
+    return 1.0 if total == 0 else warm / total
@@ -1,8 +1,20 @@
 from ninja import NinjaAPI
 
 from activity.api import router as activity_router
+from activity.tokens import StravaRateLimited
 
 api = NinjaAPI(title="NextClimb API")
 
 
+@api.exception_handler(StravaRateLimited)
+def strava_rate_limited(request, exc: StravaRateLimited):
+    response = api.create_response(
+        request,
+        {"detail": "Strava rate limit reached, please retry later", "retry_after": exc.retry_after},
+        status=503,
+    )
+    response["Retry-After"] = str(exc.retry_after)
+    return response
+
+
 api.add_router("/segment", activity_router)
@@ -138,6 +138,22 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 # custom settings
 MY_STRAVA_CLIENT_ID = os.getenv("MY_STRAVA_CLIENT_ID")
 MY_STRAVA_CLIENT_SECRET = os.getenv("MY_STRAVA_CLIENT_SECRET")
+# Refresh the access token this many seconds before Strava expires it
+STRAVA_TOKEN_REFRESH_AHEAD = 600
+STRAVA_TOKEN_LOCK_WAIT = 10
+# Every active StravaAuth row is a pooled account; calls go to the one with
+# the most quota left. Limits are Strava's defaults until the first response
+# headers for an account come in.
+STRAVA_POOL_TTL = 60
+STRAVA_SHORT_LIMIT = int(os.environ.get("STRAVA_SHORT_LIMIT", 100))
+STRAVA_DAILY_LIMIT = int(os.environ.get("STRAVA_DAILY_LIMIT", 1000))
+# Share of each window background work may use, the rest is kept for users
+STRAVA_BACKGROUND_SHARE = float(os.environ.get("STRAVA_BACKGROUND_SHARE", 0.5))
+
+# Pooled keep-alive connections to Strava and Nominatim (activity/clients.py)
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 10))
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 10))  # per host
+UPSTREAM_KEEPALIVE_EXPIRY = 30
 
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",
@@ -165,6 +181,83 @@ CACHES = {
 }
 
 
+# geocode cache tiers: in-process LRU -> Redis -> GeocodedLocation -> Nominatim
+GEOCODE_LRU_SIZE = int(os.environ.get("GEOCODE_LRU_SIZE", 2048))
+GEOCODE_CACHE_TTL = 30 * 86400
+GEOCODE_NEGATIVE_TTL = int(os.environ.get("GEOCODE_NEGATIVE_TTL", 3600))
+# Upstream timeouts and 5xx block further calls for the same query or tile,
+# doubling per consecutive failure from BACKOFF up to BACKOFF_MAX seconds
+UPSTREAM_FAILURE_BACKOFF = int(os.environ.get("UPSTREAM_FAILURE_BACKOFF", 30))
+UPSTREAM_FAILURE_BACKOFF_MAX = int(os.environ.get("UPSTREAM_FAILURE_BACKOFF_MAX", 900))
+# /segment/locations/suggest prefix index, rebuilt to pick up other workers' geocodes
+SUGGEST_INDEX_TTL = 300
+# Optional offline gazetteer, built with `manage.py build_gazetteer`
+GAZETTEER_PATH = os.environ.get("GAZETTEER_PATH", BASE_DIR / "data" / "gazetteer.bin")
+
+
+# segment tile cache
+# Searches are split into slippy-map tiles that are cached independently, so
+# overlapping searches share tiles. Zoom 10 tiles are roughly 20 miles wide.
+SEGMENT_TILE_ZOOM = int(os.environ.get("SEGMENT_TILE_ZOOM", 10))
+SEGMENT_TILE_MAX_COUNT = int(os.environ.get("SEGMENT_TILE_MAX_COUNT", 9))
+SEGMENT_TILE_FETCH_WORKERS = int(os.environ.get("SEGMENT_TILE_FETCH_WORKERS", 4))
+# Uncached tiles are answered from a cached ancestor at most this many zoom
+# levels up, and only if the ancestor held all of its segments
+SEGMENT_CONTAINMENT_MAX_LEVELS = int(os.environ.get("SEGMENT_CONTAINMENT_MAX_LEVELS", 1))
+# Tiles past the soft TTL are served stale while a background refresh runs;
+# only tiles past the hard TTL make the request wait on Strava.
+SEGMENT_CACHE_SOFT_TTL = int(os.environ.get("SEGMENT_CACHE_SOFT_TTL", 86400))
+SEGMENT_CACHE_HARD_TTL = int(os.environ.get("SEGMENT_CACHE_HARD_TTL", 3 * 86400))
+SEGMENT_REFRESH_LOCK_TTL = 60
+# Tiles Strava has no segments for are cached too, but for less time
+SEGMENT_EMPTY_TTL = int(os.environ.get("SEGMENT_EMPTY_TTL", 6 * 3600))
+# Tile payloads are stored with activity.codec; "zstd", "lz4" or "none".
+# Falls back to "none" when the library isn't installed.
+SEGMENT_CACHE_COMPRESSION = os.environ.get("SEGMENT_CACHE_COMPRESSION", "zstd")
+# Per-process L1 in front of Redis, invalidated over pub/sub (activity/l1.py)
+SEGMENT_L1_SIZE = int(os.environ.get("SEGMENT_L1_SIZE", 1024))  # tiles
+SEGMENT_L1_TTL = 300
+L1_STATS_FLUSH_INTERVAL = 10
+BACKGROUND_WORKERS = int(os.environ.get("BACKGROUND_WORKERS", 2))
+# Explored tiles younger than this are answered from the local segment index
+SEGMENT_INDEX_MAX_AGE = int(os.environ.get("SEGMENT_INDEX_MAX_AGE", 7 * 86400))
+# `manage.py warm_segment_cache`: Strava calls per run, how far back demand
+# is counted, how long before expiry tiles are refetched, and the radius
+# assumed for places we only know were geocoded
+WARM_CACHE_BUDGET = int(os.environ.get("WARM_CACHE_BUDGET", 200))
+WARM_CACHE_DAYS = 14
+WARM_CACHE_AHEAD = 6 * 3600
+WARM_CACHE_DEFAULT_RADIUS = 10
+# Encoded /segment/search responses, reused for identical repeat searches
+SEARCH_RESPONSE_TTL = int(os.environ.get("SEARCH_RESPONSE_TTL", 3600))
+# Searches fetch tiles for their center snapped to this grid (degrees) and
+# their radius rounded up to one of these buckets (miles), then filter back
+# down to the exact radius
+SEARCH_CENTER_GRID = float(os.environ.get("SEARCH_CENTER_GRID", 0.01))
+SEARCH_RADIUS_BUCKETS = (5, 10, 15, 20, 30, 50, 75, 100)
+# Query aliases (activity/aliases.py) are reloaded this often per process
+QUERY_ALIAS_TTL = 300
+# Segment geometry (activity/enrichment.py), fetched in the background for
+# searches that pass a map zoom. Polylines are simplified for each of
+# GEOMETRY_ZOOMS to within GEOMETRY_TOLERANCE_PX pixels.
+ENRICHMENT_WORKERS = int(os.environ.get("ENRICHMENT_WORKERS", 2))
+ENRICHMENT_MAX_PENDING = 200
+ENRICHMENT_RETRY_AFTER = 3600  # before a segment whose fetch failed is queued again
+SEGMENT_GEOMETRY_TTL = 30 * 86400
+GEOMETRY_ZOOMS = (8, 11, 14)
+GEOMETRY_TOLERANCE_PX = 1.0
+GEOMETRY_PROFILE_POINTS = 50
+
+# Concurrent misses on the same tile wait for a single upstream fetch
+SINGLE_FLIGHT_LOCK_TTL = 30  # seconds before a crashed leader's lock expires
+SINGLE_FLIGHT_RESULT_TTL = 60
+SINGLE_FLIGHT_WAIT = float(os.environ.get("SINGLE_FLIGHT_WAIT", 5.0))
+SINGLE_FLIGHT_POLL_INTERVAL = 0.1
+
+# Overrides for activity.difficulty.DEFAULT_SCORING weights and thresholds
+DIFFICULTY_SCORING = {}
+
+
 # Ensure the logs directory exists
 LOG_BASE_DIR = Path(__name__).resolve().parent / "logs"
 LOG_BASE_DIR.mkdir(exist_ok=True)